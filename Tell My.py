@@ -1,36 +1,83 @@
-import requests
-from math import sqrt, radians, sin, cos, atan2
-from pprint import pprint
-from datetime import datetime
-from pyicloud import PyiCloudService
-from pyicloud.exceptions import PyiCloudFailedLoginException
-from time import sleep
-import os
 import sys
-from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox
-from PyQt5.QtCore import QFile, QTimer
-from main_window_ui import Ui_MainWindow
+import time
+from metrics import metrics, StartupProfile
+
+# --profile-startup prints how long each import and step up to the first
+# window took, it's set up before anything else is imported to see it all
+profile = StartupProfile().watch_imports() if '--profile-startup' in sys.argv else None
+
+import os
+import io
+import json
+import tempfile
+from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QCheckBox, QComboBox
+from PyQt5.QtCore import QFile, QTimer, QObject, QRunnable, QThreadPool, QSortFilterProxyModel, Qt, pyqtSignal
+from PyQt5.QtGui import QStandardItem, QStandardItemModel
 from sign_in_ui import Ui_SignIn
-from two_factor_auth_ui import Ui_TwoFactorAuth
+from session_cache import SessionCache, get_password, set_password, sign_in, refresh, REFRESH_INTERVAL
 import configparser
 from appdirs import user_data_dir
 from pathlib import Path
 
 INITIAL_COUNTDOWN_TIME = 10
-COUNTDOWN_TIME = 120
+# catalog rows added per trip through the event loop
+CATALOG_CHUNK = 200
+# seconds before retrying a catalog load that failed
+CATALOG_RETRY = 10
+# item data role holding "friend" or "device" in the catalog model
+CATALOG_KIND_ROLE = Qt.UserRole + 1
+# milliseconds of quiet before queued config changes are written
+SAVE_DELAY = 500
 
 current_window = None
+config_save_timer = None
+writer_pool = QThreadPool()
+writer_pool.setMaxThreadCount(1)
 
 class SignInWindow(QMainWindow):
     def __init__(self):
         super(SignInWindow, self).__init__()
         self.ui = Ui_SignIn()
         self.ui.setupUi(self)
-        username = get_config('username', '')
-        password = get_config('passwd', '')
-        self.ui.usernameLine.setText(username)
-        self.ui.passwordLine.setText(password)
+        self.ui.usernameLine.setText(get_config('username', ''))
         self.api = None
+        self.session = None
+        # the keyring is slow to load, the form comes up first
+        QTimer.singleShot(0, self.load_saved_login)
+
+    def load_saved_login(self):
+        username = self.ui.usernameLine.text()
+        # older versions kept the password in data.ini
+        password = get_password(username) or get_config('passwd', '')
+        self.ui.passwordLine.setText(password)
+
+        if username and password:
+            self.session = SessionCache(username)
+            if self.session.restored:
+                self.resume(username, password)
+
+    def resume(self, username, password):
+        # signs in with the cached session in the background, the form is
+        # only needed if that doesn't go through without 2fa
+        self.set_resuming(True)
+        task = Task(sign_in, username, password, self.session)
+        task.signals.done.connect(self.resumed)
+        QThreadPool.globalInstance().start(task)
+
+    def resumed(self, api, error):
+        if error is None and not api.requires_2fa and not api.requires_2sa:
+            self.api = api
+            self.session.save()
+            self.continue_to_program()
+            return
+        print(f"couldn't resume session: {error or 'sign in required'}")
+        self.set_resuming(False)
+
+    def set_resuming(self, resuming):
+        self.ui.usernameLine.setEnabled(not resuming)
+        self.ui.passwordLine.setEnabled(not resuming)
+        self.ui.buttonBox.setEnabled(not resuming)
+        self.ui.label.setText("Resuming session..." if resuming else "iCloud Login")
 
     def accept(self):
         self.processSignIn()
@@ -39,329 +86,560 @@ class SignInWindow(QMainWindow):
         username = self.ui.usernameLine.text()
         password = self.ui.passwordLine.text()
         set_config('username', username)
-        set_config('passwd', password)
+        if set_password(username, password):
+            remove_config('passwd')
+        else:
+            set_config('passwd', password)
 
+        if self.session is None or self.session.username != username:
+            if self.session is not None:
+                self.session.discard()
+            self.session = SessionCache(username)
+        from pyicloud.exceptions import PyiCloudFailedLoginException
         try:
-            self.api = PyiCloudService(username, password)
+            self.api = sign_in(username, password, self.session)
         except PyiCloudFailedLoginException as e:
             show_dialog(e.args[0], "sign in error")
             return
 
         if self.api.requires_2fa:
             # the modern api
+            session, self.session = self.session, None
             self.close()
             # we make it a member so the gc doesn't cause problems
             global current_window
-            current_window = TwoFactorAuth(self.api)
+            current_window = TwoFactorAuth(self.api, session)
             current_window.show()
         elif self.api.requires_2sa:
             # the old api that sends a text message
             show_dialog("your account doesn't support 2fa", "error")
-            QApplication.quit()
+            self.reject()
         else:
             print("icloud enabled!")
+            self.session.save()
             self.continue_to_program()
 
     def continue_to_program(self):
+        session, self.session = self.session, None
         self.close()
-        # we make it a member so the gc doesn't cause problems
-        global current_window
-        current_window = MainWindow(self.api)
-        current_window.show()
+        show_main_window(self.api, session)
 
     def reject(self):
+        self.close()
         QApplication.quit()
 
+    def closeEvent(self, event):
+        # quitting before signing in, the session goes nowhere
+        if self.session is not None:
+            self.session.discard()
+            self.session = None
+        event.accept()
+
 
 class TwoFactorAuth(QMainWindow):
-    def __init__(self, api):
+    def __init__(self, api, session):
         super(TwoFactorAuth, self).__init__()
+        from two_factor_auth_ui import Ui_TwoFactorAuth
         self.ui = Ui_TwoFactorAuth()
         self.ui.setupUi(self)
         self.api = api
+        self.session = session
 
     def accept(self):
         code = self.ui.lineEdit.text()
         if self.api.validate_2fa_code(code):
+            # now trusted, cache it so the next launch skips 2fa
+            self.session.save()
             self.continue_to_program()
         else:
             print("Code failed")
 
     def continue_to_program(self):
+        session, self.session = self.session, None
         self.close()
-        # we make it a member so the gc doesn't cause problems
-        global current_window
-        current_window = MainWindow(self.api)
-        current_window.show()
+        show_main_window(self.api, session)
 
     def reject(self):
+        self.close()
         QApplication.quit()
 
+    def closeEvent(self, event):
+        if self.session is not None:
+            self.session.discard()
+            self.session = None
+        event.accept()
+
+
+def show_main_window(api, session):
+    if profile:
+        profile.mark('signed in')
+    load_tracker()
+    # we make it a member so the gc doesn't cause problems
+    global current_window
+    current_window = MainWindow(ICloudProvider(api), session)
+    current_window.show()
+    if profile:
+        profile.mark('main window built')
+        QTimer.singleShot(0, lambda: profile_shown('main window'))
+
+tracker_loaded = False
+
+def load_tracker():
+    # the tracker and what it pulls in (numpy, sqlite, asyncio) aren't
+    # needed until signed in, importing them here instead of at the top
+    # keeps them off the way to the first window
+    global tracker_loaded
+    if tracker_loaded:
+        return
+    global LocationSnapshot, LastKnownGood, LocationHistory, PollScheduler, next_interval
+    global COALESCE_WINDOW, default_dispatcher, ICloudProvider, PushServer, ResilientProvider
+    global TrackingConfig, RuleGraph, needed_fetches, format_log_entry, LOG_CAPACITY, RULE_FIELDS
+    global DEVICE_FIELDS
+    from snapshot import LocationSnapshot, LastKnownGood
+    from history import LocationHistory
+    from scheduler import PollScheduler, next_interval, COALESCE_WINDOW
+    from notifications import default_dispatcher
+    from providers import ICloudProvider
+    from push_server import PushServer
+    from resilience import ResilientProvider
+    from tracking import (TrackingConfig, RuleGraph, needed_fetches, format_log_entry, LOG_CAPACITY,
+                          RULE_FIELDS, DEVICE_FIELDS)
+    tracker_loaded = True
+
 
 class MainWindow(QMainWindow):
-    def __init__(self, api):
+    def __init__(self, provider, session=None):
         super(MainWindow, self).__init__()
-        self.api = api
+        load_tracker()
+        from main_window_ui import Ui_MainWindow
+        self.provider = ResilientProvider(provider)
+        self.last_known = LastKnownGood()
+        self.session = session
         self.ui = Ui_MainWindow()
         self.ui.setupUi(self)
 
-        self.available_devices = self.api.devices
-        self.available_friends = self.api.friends.contact_details
-        self.available_devices_names = [f'{x["name"]} ({x["deviceDisplayName"]})' for x in self.available_devices]
-        self.available_friends_names = [f'{x["firstName"]} {x["lastName"]}' for x in self.available_friends]
-        self.ui.availableDevicesBox.addItems(self.available_friends_names)
-        self.ui.availableDevicesBox.addItems(self.available_devices_names)
-        self.ui.watch_movement_device_adb.addItems(self.available_devices_names)
-        self.ui.proximity_to.addItems(self.available_devices_names)
-        self.ui.watch_proximity_device_adb.addItems(self.available_devices_names)
+        # friends then devices, filled in once the catalog loads. the add box
+        # shows all of it, the device combos share one filtered view of it
+        self.available_devices = []
+        self.available_friends = []
+        # device id -> row in the device combos
+        self.device_rows = {}
+        self.catalog = QStandardItemModel(self)
+        self.device_catalog = QSortFilterProxyModel(self)
+        self.device_catalog.setSourceModel(self.catalog)
+        self.device_catalog.setFilterRole(CATALOG_KIND_ROLE)
+        self.device_catalog.setFilterFixedString("device")
+        self.ui.availableDevicesBox.setModel(self.catalog)
+        self.ui.watch_movement_device_adb.setModel(self.device_catalog)
+        self.ui.proximity_to.setModel(self.device_catalog)
+        self.ui.watch_proximity_device_adb.setModel(self.device_catalog)
+        self.ui.addButton.setEnabled(False)
+        self.catalog_ready = False
+        self.catalog_rows = []
+        self.load_catalog()
 
         self.tracked = []
+        # which trackees a cycle has to look at again
+        self.graph = RuleGraph()
+        self.locating = False
+        self.log_capacity = int(get_config('log_capacity', LOG_CAPACITY))
+        self.ui.log_box.setMaximumBlockCount(self.log_capacity)
+        # the trackee whose log is in log_box and how many of its entries are shown
+        self.shown_log = None
+        self.shown_log_count = 0
+        # what the rule widgets show with nothing selected
+        self.blank_trackee = TrackingConfig(None, None, "")
+        # the selected trackee, as of the last full refresh
+        self.current = None
+
+        data_dir = os.path.dirname(config_path)
+        os.makedirs(data_dir, exist_ok=True)
+        self.history = LocationHistory(os.path.join(data_dir, 'history.db'))
+        self.notifier = default_dispatcher(os.path.join(data_dir, 'alerts.log'))
+        # push_port in data.ini streams positions and alerts to local tools
+        self.push = None
+        if get_config('push_port'):
+            try:
+                self.push = PushServer(int(get_config('push_port'))).start()
+                self.notifier.register('log', self.push.alert_sink())
+            except (OSError, ValueError) as e:
+                print(f"couldn't start the push server: {e}")
+        self.metrics_path = os.path.join(data_dir, 'metrics.prom')
+        self.tracked_path = os.path.join(data_dir, 'tracked.json')
+
+        # edits come in bursts (a spin box fires per keystroke), write once they settle
+        self.save_timer = QTimer()
+        self.save_timer.setSingleShot(True)
+        self.save_timer.setInterval(SAVE_DELAY)
+        self.save_timer.timeout.connect(self.save_tracked)
 
         self.ui.watch_movement.stateChanged.connect(lambda x: self.update_device_config('watch_movement', x))
         self.ui.tolerance.valueChanged.connect(lambda x: self.update_device_config('tolerance', x))
         self.ui.watch_movement_audio.stateChanged.connect(lambda x: self.update_device_config('watch_movement_audio', x))
         self.ui.watch_movement_device_cb.stateChanged.connect(lambda x: self.update_device_config('watch_movement_device_cb', x))
-        self.ui.watch_movement_device_adb.currentIndexChanged.connect(lambda x: self.update_device_config('watch_movement_device_adb', x))
+        self.ui.watch_movement_device_adb.currentIndexChanged.connect(lambda x: self.update_device_config('watch_movement_device_adb', self.device_id(x)))
         
         self.ui.watch_proximity.stateChanged.connect(lambda x: self.update_device_config('watch_proximity', x))
-        self.ui.proximity_to.currentIndexChanged.connect(lambda x: self.update_device_config('proximity_to', x))
+        self.ui.proximity_to.currentIndexChanged.connect(lambda x: self.update_device_config('proximity_to', self.device_id(x)))
         self.ui.distance.valueChanged.connect(lambda x: self.update_device_config('distance', x))
         self.ui.watch_proximity_audio.stateChanged.connect(lambda x: self.update_device_config('watch_proximity_audio', x))
         self.ui.watch_proximity_device_cb.stateChanged.connect(lambda x: self.update_device_config('watch_proximity_device_cb', x))
-        self.ui.watch_proximity_device_adb.currentIndexChanged.connect(lambda x: self.update_device_config('watch_proximity_device_adb', x))
+        self.ui.watch_proximity_device_adb.currentIndexChanged.connect(lambda x: self.update_device_config('watch_proximity_device_adb', self.device_id(x)))
+
+        self.scheduler = PollScheduler()
+
+        # keep the cached session fresh so the next launch can reuse it
+        self.session_timer = QTimer()
+        self.session_timer.setInterval(REFRESH_INTERVAL * 1000)
+        self.session_timer.timeout.connect(self.refresh_session)
+        if self.session is not None:
+            self.session_timer.start()
 
-        self.countdown = INITIAL_COUNTDOWN_TIME
         self.timer = QTimer()
         self.timer.setInterval(1000)
         self.timer.timeout.connect(self.recurring_timer)
         self.timer.start()
 
 
+    def load_catalog(self):
+        self.ui.statusbar.showMessage('Loading devices and friends...')
+        task = Task(load_catalog, self.provider)
+        task.signals.done.connect(self.catalog_loaded)
+        QThreadPool.globalInstance().start(task)
+
+    def catalog_loaded(self, catalog, error):
+        if error is not None:
+            print(f"failed to load devices and friends: {error}")
+            self.ui.statusbar.showMessage(f'Failed to load devices and friends, retrying in {CATALOG_RETRY} s')
+            QTimer.singleShot(CATALOG_RETRY * 1000, self.load_catalog)
+            return
+        self.available_friends, self.available_devices, self.catalog_rows = catalog
+        self.device_rows = {x['id']: idx for idx, x in enumerate(self.available_devices)}
+        self.add_catalog_rows()
+
+    def add_catalog_rows(self):
+        # a chunk at a time so huge accounts don't stall the event loop
+        chunk = self.catalog_rows[:CATALOG_CHUNK]
+        self.catalog_rows = self.catalog_rows[CATALOG_CHUNK:]
+        for kind, name in chunk:
+            item = QStandardItem(name)
+            item.setData(kind, CATALOG_KIND_ROLE)
+            self.catalog.appendRow(item)
+        if self.catalog_rows:
+            QTimer.singleShot(0, self.add_catalog_rows)
+        else:
+            self.catalog_ready = True
+            self.ui.addButton.setEnabled(True)
+            self.restore_tracked()
+
+    def restore_tracked(self):
+        try:
+            with open(self.tracked_path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"couldn't read tracked list: {e}")
+            return
+
+        friends = {x['id']: x for x in self.available_friends}
+        devices = {x['id']: x for x in self.available_devices}
+        for entry in saved:
+            api_object = (friends if entry['type'] == "friend" else devices).get(entry['id'])
+            if api_object is None:
+                print(f"{entry['display_name']} is no longer available, not tracking it")
+                continue
+            trackee = TrackingConfig(entry['type'], api_object, entry['display_name'], self.log_capacity)
+            for field in RULE_FIELDS:
+                if field in entry:
+                    trackee[field] = entry[field]
+            self.add_trackee(trackee)
+
+    def save_tracked(self):
+        saved = []
+        for trackee in self.tracked:
+            entry = {'type': trackee.type, 'id': trackee.id, 'display_name': trackee.display_name}
+            for field in RULE_FIELDS:
+                entry[field] = trackee[field]
+            saved.append(entry)
+        write_file(self.tracked_path, json.dumps(saved, indent=2))
+
     def addButtonClick(self):
         idx = self.ui.availableDevicesBox.currentIndex()
+        if idx == -1:
+            return
+        display_name = self.catalog.item(idx).text()
         if idx < len(self.available_friends):
             friend = self.available_friends[idx]
-            display_name = self.available_friends_names[idx]
-            self.ui.tracked.addItem(display_name)
-            self.tracked.append(TrackingConfig("friend", friend, display_name))
+            self.add_trackee(TrackingConfig("friend", friend, display_name, self.log_capacity))
         else:
             device = self.available_devices[idx - len(self.available_friends)]
-            display_name = self.available_devices_names[idx - len(self.available_friends)]
-            self.ui.tracked.addItem(display_name)
-            self.tracked.append(TrackingConfig("device", device, display_name))
+            self.add_trackee(TrackingConfig("device", device, display_name, self.log_capacity))
+        self.save_timer.start()
+
+    def add_trackee(self, trackee):
+        # device rules start out on the first device, as the combos show,
+        # and fall back to it when the device they named is gone
+        for field in DEVICE_FIELDS:
+            if trackee[field] not in self.device_rows and self.available_devices:
+                trackee[field] = self.available_devices[0]['id']
+        trackee.on_change = self.trackee_changed
+        self.ui.tracked.addItem(trackee.display_name)
+        self.tracked.append(trackee)
+        self.graph.watch(trackee)
+        self.scheduler.schedule(trackee, INITIAL_COUNTDOWN_TIME)
 
     def removeButtonClick(self):
         idx = self.ui.tracked.currentRow()
         if idx == -1:
             return
-        self.ui.tracked.takeItem(idx)
+        trackee = self.tracked[idx]
+        trackee.on_change = None
+        self.scheduler.remove(trackee)
+        self.graph.forget(trackee)
+        # drop it from the list before the selection change refreshes the ui
         del self.tracked[idx]
+        self.ui.tracked.takeItem(idx)
+        self.save_timer.start()
 
     def selectedDeviceChanged(self, idx):
         self.update_ui()
-    
-    def update_ui(self):
-        idx = self.ui.tracked.currentRow()
-        if idx == -1:
-            self.ui.watch_movement.setEnabled(False)
-            self.ui.watch_movement.setChecked(False)
 
-            self.ui.tolerance.setEnabled(False)
-            self.ui.tolerance_label.setEnabled(False)
-            self.ui.tolerance.setValue(500.0)
-
-            self.ui.watch_movement_audio.setEnabled(False)
-            self.ui.watch_movement_audio.setChecked(False)
-
-            self.ui.watch_movement_device_cb.setEnabled(False)
-            self.ui.watch_movement_device_cb.setChecked(False)
-
-            self.ui.watch_movement_device_adb.setEnabled(False)
-            self.ui.watch_movement_device_adb.setCurrentIndex(0)
-
-            self.ui.watch_proximity.setEnabled(False)
-            self.ui.watch_proximity.setChecked(False)
-
-            self.ui.proximity_to.setEnabled(False)
-            self.ui.proximity_to_label.setEnabled(False)
-            self.ui.proximity_to.setCurrentIndex(0)
-
-            self.ui.distance.setEnabled(False)
-            self.ui.distance_label.setEnabled(False)
-            self.ui.distance.setValue(500.0)
-
-            self.ui.watch_proximity_audio.setEnabled(False)
-            self.ui.watch_proximity_audio.setChecked(False)
-
-            self.ui.watch_proximity_device_cb.setEnabled(False)
-            self.ui.watch_proximity_device_cb.setChecked(False)
-
-            self.ui.watch_proximity_device_adb.setEnabled(False)
-            self.ui.watch_proximity_device_adb.setCurrentIndex(0)
+    def selected(self):
+        idx = self.ui.tracked.currentRow()
+        return self.tracked[idx] if 0 <= idx < len(self.tracked) else None
 
-            self.ui.log_box.setPlainText("")
+    @metrics.timed('update_ui')
+    def update_ui(self):
+        # full refresh, only needed when the selection changes. the widgets
+        # are named after the rule fields they show
+        dev = self.current = self.selected()
+        values = dev or self.blank_trackee
+        for field in RULE_FIELDS:
+            self.show_field(field, values[field])
+        self.update_enabled(dev)
+        self.show_log(dev)
+
+    def trackee_changed(self, trackee, field):
+        # fine grained updates, changes to trackees that aren't selected cost nothing
+        if trackee is not self.current:
             return
-        dev = self.tracked[idx]
-
-        self.ui.watch_movement.setEnabled(True)
-        self.ui.watch_movement.setChecked(dev.watch_movement)
-
-        self.ui.tolerance.setEnabled(dev.watch_movement)
-        self.ui.tolerance_label.setEnabled(dev.watch_movement)
-        self.ui.tolerance.setValue(dev.tolerance)
-
-        self.ui.watch_movement_audio.setEnabled(dev.watch_movement)
-        self.ui.watch_movement_audio.setChecked(dev.watch_movement_audio)
-
-        self.ui.watch_movement_device_cb.setEnabled(dev.watch_movement)
-        self.ui.watch_movement_device_cb.setChecked(dev.watch_movement_device_cb)
-
-        self.ui.watch_movement_device_adb.setEnabled(dev.watch_movement and dev.watch_movement_device_cb)
-        self.ui.watch_movement_device_adb.setCurrentIndex(dev.watch_movement_device_adb)
-
-        self.ui.watch_proximity.setEnabled(True)
-        self.ui.watch_proximity.setChecked(dev.watch_proximity)
-
-        self.ui.proximity_to.setEnabled(dev.watch_proximity)
-        self.ui.proximity_to_label.setEnabled(dev.watch_proximity)
-        self.ui.proximity_to.setCurrentIndex(dev.proximity_to)
-
-        self.ui.distance.setEnabled(dev.watch_proximity)
-        self.ui.distance_label.setEnabled(dev.watch_proximity)
-        self.ui.distance.setValue(dev.distance)
-
-        self.ui.watch_proximity_audio.setEnabled(dev.watch_proximity)
-        self.ui.watch_proximity_audio.setChecked(dev.watch_proximity_audio)
-
-        self.ui.watch_proximity_device_cb.setEnabled(dev.watch_proximity)
-        self.ui.watch_proximity_device_cb.setChecked(dev.watch_proximity_device_cb)
-
-        self.ui.watch_proximity_device_adb.setEnabled(dev.watch_proximity and dev.watch_proximity_device_cb)
-        self.ui.watch_proximity_device_adb.setCurrentIndex(dev.watch_proximity_device_adb)
+        if field == 'log':
+            self.show_log(trackee)
+        elif field in RULE_FIELDS:
+            self.show_field(field, trackee[field])
+            self.update_enabled(trackee)
+
+    def show_field(self, field, value):
+        widget = getattr(self.ui, field)
+        # setting a widget programmatically mustn't loop back through update_device_config
+        blocked = widget.blockSignals(True)
+        if isinstance(widget, QCheckBox):
+            if widget.isChecked() != bool(value):
+                widget.setChecked(bool(value))
+        elif isinstance(widget, QComboBox):
+            # device combos hold the id, shown as its row
+            row = self.device_rows.get(value, -1)
+            if widget.currentIndex() != row:
+                widget.setCurrentIndex(row)
+        elif widget.value() != value:
+            widget.setValue(value)
+        widget.blockSignals(blocked)
+
+    def update_enabled(self, dev):
+        movement = bool(dev and dev.watch_movement)
+        proximity = bool(dev and dev.watch_proximity)
+        ui = self.ui
+        states = [
+            (ui.watch_movement, dev is not None),
+            (ui.tolerance, movement),
+            (ui.tolerance_label, movement),
+            (ui.watch_movement_audio, movement),
+            (ui.watch_movement_device_cb, movement),
+            (ui.watch_movement_device_adb, movement and bool(dev.watch_movement_device_cb)),
+            (ui.watch_proximity, dev is not None),
+            (ui.proximity_to, proximity),
+            (ui.proximity_to_label, proximity),
+            (ui.distance, proximity),
+            (ui.distance_label, proximity),
+            (ui.watch_proximity_audio, proximity),
+            (ui.watch_proximity_device_cb, proximity),
+            (ui.watch_proximity_device_adb, proximity and bool(dev.watch_proximity_device_cb)),
+        ]
+        for widget, enabled in states:
+            if widget.isEnabled() != enabled:
+                widget.setEnabled(enabled)
+
+    def show_log(self, dev):
+        # only appends entries logged since the last refresh, the whole
+        # log is only rendered when the selection changes
+        if dev is not self.shown_log:
+            self.shown_log = dev
+            self.shown_log_count = dev.log_count if dev else 0
+            self.ui.log_box.setPlainText("\n".join(map(format_log_entry, dev.log_entries)) if dev else "")
+            return
+        if dev is None:
+            return
+        new = dev.log_count - self.shown_log_count
+        if new > 0:
+            for entry in dev.log_entries.tail(new):
+                self.ui.log_box.appendPlainText(format_log_entry(entry))
+        self.shown_log_count = dev.log_count
 
-        self.ui.log_box.setPlainText(dev.log_box)
+    def device_id(self, row):
+        return self.available_devices[row]['id'] if 0 <= row < len(self.available_devices) else None
 
     def update_device_config(self, prop, val):
         idx = self.ui.tracked.currentRow()
-        self.tracked[idx][prop] = val
-        self.update_ui()
+        if idx == -1:
+            return
+        trackee = self.tracked[idx]
+        trackee[prop] = val
+        # check the edited rule soon rather than a long parked interval from now
+        self.scheduler.schedule(trackee, INITIAL_COUNTDOWN_TIME)
+        self.save_timer.start()
+
+    def refresh_session(self):
+        task = Task(refresh, self.provider.api, self.session)
+        task.signals.done.connect(self.session_refreshed)
+        QThreadPool.globalInstance().start(task)
+
+    def session_refreshed(self, result, error):
+        if error is not None:
+            print(f"failed to refresh session: {error}")
+
+    def closeEvent(self, event):
+        if self.save_timer.isActive():
+            self.save_timer.stop()
+            self.save_tracked()
+        # a locate cycle still running writes to the history
+        QThreadPool.globalInstance().waitForDone()
+        self.history.close()
+        if self.session is not None:
+            self.session.close()
+        if self.push is not None:
+            self.push.stop()
+        super(MainWindow, self).closeEvent(event)
 
     def recurring_timer(self):
-        if self.countdown == 0:
-            self.locate()
-            self.countdown = COUNTDOWN_TIME
-        self.ui.statusbar.showMessage(f'Seconds until next locate: {self.countdown}')
-        self.countdown -= 1
-
-    def locate(self):
-        for trackee in self.tracked:
-            handle(trackee, self.api)
-        self.update_ui()
-
-def find_distance(location1, location2):
-    lat1 = location1['latitude']
-    lng1 = location1['longitude']
-    lat2 = location2['latitude']
-    lng2 = location2['longitude']
-
-    earthRadius = 6371000.0
-    dLat = radians(lat2-lat1);
-    dLng = radians(lng2-lng1);
-    a = sin(dLat/2) * sin(dLat/2) + \
-        cos(radians(lat1)) * cos(radians(lat2)) * \
-        sin(dLng/2) * sin(dLng/2);
-    c = 2 * atan2(sqrt(a), sqrt(1-a));
-
-    return earthRadius * c;
-
-def handle(config, api):
-    if config.type == "friend":
-        friend_id = config.api_object['id']
-        location = next(friend['location'] for friend in api.friends.locations if friend['id'] == friend_id)
-    else:
-        location = config.api_object.location()
-
-    # couldn't retrieve location
-    if not location:
-        if (config.watch_movement and config.watch_movement_audio) or \
-            (config.watch_proximity and config.watch_proximity_audio):
-            say_aloud(f"Error retrieving location")
-        config.log(f"Error retrieving location")
-        return
-
-    config.log(datetime.now())
-    config.log(f"lat {location['latitude']}, lng {location['longitude']}")
-
-    # movement logic
-    if config.watch_movement and hasattr(config, 'last_location'):
-        # while tracking movement, only update lastlocation 
-        # after a detection to prevent creeping
-        dist = find_distance(device.last_location, location)
-        config.log(f"Delta distance (meters): {dist}")
-        if dist >= config.tolerance:
-            msg = f"{config.display_name} has moved." 
-            notify('Movement Detected', msg)
-            if config.watch_movement_audio:
-                say_aloud(msg)
-            if config.watch_movement_device_cb:
-                api.devices[config.watch_movement_device_adb].display_message(subject="this doesnt get shown",message=msg,sounds=True)
-            config.log(msg)
-            device.last_location = location
-    else:
-        config.last_location = location
-
-    # proximity logic
-    if config.watch_proximity:
-        proximity_to_device = available_devices[device.config.proximity_to]
-        ptd_name = proximity_to_device["name"]
-        dist = find_distance(location, proximity_to_device)
-        if dist < config.distance:
-            msg = f"{ptd_name} is near {config.display_name}"
-            notify('Proximity Detected', msg)
-            if config.watch_proximity_audio:
-                say_aloud(msg)
-            if config.watch_proximity_device_cb:
-                available_devices[config.watch_proximity_device_adb].display_message(subject="this doesnt get shown",message=msg,sounds=True)
-            config.log(msg)
-
-def say_aloud(text):
-    os.system(f'say "{text}"')
-
-def notify(title, text):
-    os.system("""
-              osascript -e 'display notification "{}" with title "{}"'
-              """.format(text, title))
-    
-class TrackingConfig:
-    def __init__(self, type, api_object, display_name):
-        # either "device" or "friend"
-        self.type = type
-        self.api_object = api_object
-        self.display_name = display_name
-
-        self.watch_movement = False
-        self.tolerance = 500.0
-        self.watch_movement_audio = False
-        self.watch_movement_device_cb = False
-        self.watch_movement_device_adb = 0
-
-        self.watch_proximity = False
-        self.proximity_to = 0
-        self.distance = 500.0
-        self.watch_proximity_audio = False
-        self.watch_proximity_device_cb = False
-        self.watch_proximity_device_adb = 0
-
-        self.log_box = ""
-
-    def __getitem__(self, key):
-        return getattr(self, key)
-
-    def __setitem__(self, key, val):
-        return setattr(self, key, val)
-
-    def log(self, msg):
-        self.log_box += str(msg) + "\n"
+        # a slow cycle is still running, wait for it rather than pile up
+        if not self.locating and self.scheduler.next_due() == 0:
+            self.locate(self.scheduler.pop_due(COALESCE_WINDOW))
+        wait = self.scheduler.next_due()
+        if self.locating:
+            self.ui.statusbar.showMessage('Locating...')
+        elif wait is None:
+            # leave catalog loading messages up
+            if self.catalog_ready:
+                self.ui.statusbar.showMessage('')
+        else:
+            message = f'Seconds until next locate: {int(wait)}'
+            retry = self.provider.retry_in()
+            if retry is not None:
+                message += f'    iCloud unavailable, retrying in {int(retry)} s'
+            if metrics.enabled and metrics.last('locate') is not None:
+                message += f'    Last locate: {metrics.last("locate"):.2f} s'
+                for name in ('fetch_friends', 'fetch_devices', 'update_ui'):
+                    if metrics.last(name) is not None:
+                        message += f', {name.replace("_", " ")} {metrics.last(name):.2f} s'
+            self.ui.statusbar.showMessage(message)
+
+    def locate(self, trackees):
+        self.locating = True
+        self.locate_started = time.perf_counter()
+        need_friends, need_devices = needed_fetches(trackees)
+        self.scheduler.spend(need_friends + need_devices)
+        worker = LocateWorker(trackees, self.provider, self.history, self.last_known,
+                              need_friends, need_devices)
+        worker.signals.located.connect(self.located)
+        QThreadPool.globalInstance().start(worker)
+
+    def located(self, trackees, snapshot):
+        # runs on the gui thread once the cycle's snapshot has been fetched.
+        # whatever goes wrong, the trackees are rescheduled and the next
+        # cycle can start
+        try:
+            # skip trackees removed while the cycle was in flight
+            trackees = [trackee for trackee in trackees if trackee in self.tracked]
+            try:
+                self.graph.evaluate(trackees, snapshot, self.notifier)
+            except Exception as e:
+                print(f"failed to check the rules: {e}")
+            for trackee in trackees:
+                trackee.poll_interval = next_interval(trackee.poll_interval, trackee.speed, trackee.margin)
+                self.scheduler.schedule(trackee, trackee.poll_interval)
+            if self.push is not None:
+                self.push.publish(trackees)
+        finally:
+            self.locating = False
+            metrics.observe('locate', time.perf_counter() - self.locate_started)
+            metrics.count('cycles')
+            metrics.export(self.metrics_path)
+
+
+def load_catalog(provider):
+    # blocking, run it on the thread pool. names are built here once and
+    # shared by every combo box through the catalog model
+    friends = provider.friends()
+    devices = provider.devices()
+    rows = [("friend", f'{x["firstName"]} {x["lastName"]}') for x in friends]
+    rows += [("device", f'{x["name"]} ({x["deviceDisplayName"]})') for x in devices]
+    return friends, devices, rows
+
+
+class TaskSignals(QObject):
+    done = pyqtSignal(object, object)
+
+
+class Task(QRunnable):
+    # runs func(*args) on the thread pool, done gets (result, exception)
+    def __init__(self, func, *args):
+        super(Task, self).__init__()
+        self.func = func
+        self.args = args
+        self.signals = TaskSignals()
+
+    def run(self):
+        try:
+            result = self.func(*self.args)
+        except Exception as e:
+            self.signals.done.emit(None, e)
+            return
+        self.signals.done.emit(result, None)
+
+
+class LocateSignals(QObject):
+    located = pyqtSignal(list, object)
+
+
+class LocateWorker(QRunnable):
+    # fetches one location snapshot for the cycle off the gui thread,
+    # friends and devices concurrently
+    def __init__(self, trackees, provider, history, last_known, need_friends=True, need_devices=True):
+        super(LocateWorker, self).__init__()
+        self.trackees = trackees
+        self.provider = provider
+        self.history = history
+        self.last_known = last_known
+        self.need_friends = need_friends
+        self.need_devices = need_devices
+        self.signals = LocateSignals()
+
+    def run(self):
+        # located is always sent, an empty snapshot if the fetch failed, so
+        # the window never waits on a cycle that's gone
+        snapshot = LocationSnapshot()
+        try:
+            snapshot = LocationSnapshot.fetch(self.provider, self.need_friends, self.need_devices, self.last_known)
+            # the whole cycle's fixes go to disk in one transaction, off the gui thread
+            try:
+                self.history.append((t.id, snapshot.location(t)) for t in self.trackees)
+            except Exception as e:
+                print(f"failed to save location history: {e}")
+        except Exception as e:
+            print(f"failed to locate: {e}")
+        finally:
+            self.signals.located.emit(self.trackees, snapshot)
 
 def get_config(key, default=None):
     return config.get('data', key, fallback=default)
@@ -370,14 +648,60 @@ def set_config(key, value):
     if 'data' not in config.sections():
         config.add_section('data')
     config.set('data', key, value)
-    if not os.path.exists(os.path.dirname(config_path)):
-        try:
-            os.makedirs(os.path.dirname(config_path))
-        except OSError as exc: # Guard against race condition
-            if exc.errno != errno.EEXIST:
-                raise
-    with open(config_path, "w") as f:
-        config.write(f)
+    save_config()
+
+def remove_config(key):
+    if config.has_option('data', key):
+        config.remove_option('data', key)
+        save_config()
+
+def save_config():
+    # changes made in quick succession are written together once they settle
+    global config_save_timer
+    if config_save_timer is None:
+        config_save_timer = QTimer()
+        config_save_timer.setSingleShot(True)
+        config_save_timer.setInterval(SAVE_DELAY)
+        config_save_timer.timeout.connect(write_config)
+    config_save_timer.start()
+
+def write_config():
+    contents = io.StringIO()
+    config.write(contents)
+    write_file(config_path, contents.getvalue())
+
+def flush_config():
+    # writes anything still waiting on the save delay, and waits for writes
+    # in flight, so nothing is lost on quit
+    if config_save_timer is not None and config_save_timer.isActive():
+        config_save_timer.stop()
+        write_config()
+    writer_pool.waitForDone()
+
+def write_file(path, contents):
+    # one writer thread, so writes land in the order they were made
+    task = Task(write_atomic, path, contents)
+    task.signals.done.connect(file_written)
+    writer_pool.start(task)
+
+def file_written(result, error):
+    if error is not None:
+        print(f"failed to save: {error}")
+
+def write_atomic(path, contents):
+    # readers see either the old file or the new one, never a partial write
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
 
 def show_dialog(self, message, title="alert"):
     msgbox = QMessageBox()
@@ -389,14 +713,31 @@ def show_dialog(self, message, title="alert"):
     if returnvalue == QMessageBox.Ok:
         pass
 
+def profile_shown(window):
+    # runs once the event loop has got to the shown window
+    profile.mark(f"{window} shown")
+    profile.report(window)
+    if window == 'main window':
+        profile.stop()
+
 if __name__ == "__main__":
+    if profile:
+        profile.mark('imports')
     app = QApplication(sys.argv)
+    app.aboutToQuit.connect(flush_config)
+    if profile:
+        profile.mark('QApplication')
 
     config = configparser.ConfigParser()
     config_path = Path(user_data_dir('Tell My', 'cw')) / 'data.ini'
     config.read(config_path)
 
+    if profile:
+        # queued first, so it runs before the window's own deferred work
+        QTimer.singleShot(0, lambda: profile_shown('sign in window'))
     current_window = SignInWindow()
     current_window.show()
+    if profile:
+        profile.mark('sign in window built')
 
     app.exec_()
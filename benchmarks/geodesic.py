@@ -0,0 +1,46 @@
+"""
+Compares the scalar haversine loop with the vectorized all-pairs distance
+matrix in geodesic.py.
+
+Usage:
+    python benchmarks/geodesic.py
+"""
+
+import os
+import random
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from geodesic import haversine, distance_matrix
+
+SIZES = [10, 100, 1000]
+
+
+def random_points(n):
+    lats = [random.uniform(-80.0, 80.0) for _ in range(n)]
+    lngs = [random.uniform(-180.0, 180.0) for _ in range(n)]
+    return lats, lngs
+
+def scalar_matrix(lats, lngs):
+    return [[haversine(lat1, lng1, lat2, lng2) for lat2, lng2 in zip(lats, lngs)]
+            for lat1, lng1 in zip(lats, lngs)]
+
+def main():
+    random.seed(0)
+    print(f"{'points':>8} {'pairs':>10} {'scalar (s)':>12} {'numpy (s)':>12} {'speedup':>9}")
+    for n in SIZES:
+        lats, lngs = random_points(n)
+
+        # both implementations must agree before the timings mean anything
+        assert np.allclose(scalar_matrix(lats, lngs), distance_matrix(lats, lngs), rtol=1e-9, atol=1e-6)
+
+        number = max(1, 10000 // (n * n))
+        scalar = timeit(lambda: scalar_matrix(lats, lngs), number=number) / number
+        vector = timeit(lambda: distance_matrix(lats, lngs), number=number) / number
+        print(f"{n:>8} {n * n:>10} {scalar:>12.6f} {vector:>12.6f} {scalar / vector:>8.1f}x")
+
+if __name__ == "__main__":
+    main()
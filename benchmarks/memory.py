@@ -0,0 +1,135 @@
+"""
+Measures how much memory each trackee holds on to once its log has filled
+up: the TrackingConfig and its filter and log, and its share of the
+locations kept between cycles. The simulated provider's responses are
+padded with the fields icloud really sends, so holding on to a response
+costs what it would live.
+
+Usage:
+    python benchmarks/memory.py
+    python benchmarks/memory.py --trackees 500 --cycles 1000
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from notifications import NotificationDispatcher
+from providers import SimulatedProvider
+from snapshot import LocationSnapshot, LastKnownGood
+from tracking import TrackingConfig, handle, LOG_CAPACITY
+
+# seconds of simulated time between cycles
+CYCLE_TIME = 120
+
+
+class VirtualClock:
+    def __init__(self, now=1600000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class ICloudShapedProvider(SimulatedProvider):
+    # the simulated provider with every location and friend padded out to
+    # roughly what the find my web service returns
+    def friends(self):
+        return [dict(friend, **friend_fields(friend['id'])) for friend in super(ICloudShapedProvider, self).friends()]
+
+    def friend_locations(self):
+        return [dict(friend, location=location_fields(friend['location']), status=None, locationStatus=None)
+                for friend in super(ICloudShapedProvider, self).friend_locations()]
+
+
+def location_fields(location):
+    return dict(location, **{
+        'locationId': str(uuid.uuid4()),
+        'altitude': 0.0,
+        'verticalAccuracy': 0.0,
+        'floorLevel': 0,
+        'isInaccurate': False,
+        'isOld': False,
+        'locationFinished': True,
+        'locationType': None,
+        'tempLangForAddrAndPremises': None,
+        'address': {
+            'formattedAddressLines': ['1 Infinite Loop', 'Cupertino, CA  95014', 'United States'],
+            'streetAddress': '1 Infinite Loop',
+            'locality': 'Cupertino',
+            'administrativeArea': 'CA',
+            'stateCode': 'CA',
+            'country': 'United States',
+            'countryCode': 'US',
+            'mapItemFullAddress': '1 Infinite Loop, Cupertino, CA  95014, United States',
+        },
+    })
+
+def friend_fields(key):
+    return {
+        'emails': [f'{key}@example.com'],
+        'phones': ['+1 (408) 555-0100'],
+        'middleName': None,
+        'prefix': None,
+        'suffix': None,
+        'photoUrl': f'https://p00-contacts.icloud.com/{key}/photo.jpg',
+        'contactId': str(uuid.uuid4()),
+        'contactEmail': f'{key}@example.com',
+        'isFriend': True,
+        'isFamily': False,
+    }
+
+def run(trackees_n, cycles):
+    clock = VirtualClock()
+    provider = ICloudShapedProvider(devices=1, friends=trackees_n, clock=clock)
+    notifier = NotificationDispatcher()
+
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+
+    # what the app keeps: the trackees built from the friends response and
+    # the last good fetch, to fall back on through an outage
+    trackees = []
+    target = provider.devices()[0]['id']
+    for friend in provider.friends():
+        trackee = TrackingConfig("friend", friend, friend['lastName'])
+        trackee.watch_movement = True
+        trackee.watch_proximity = True
+        trackee.proximity_to = target
+        trackee.tolerance = 300.0
+        trackees.append(trackee)
+    last_known = LastKnownGood(clock)
+    gc.collect()
+    built = tracemalloc.get_traced_memory()[0]
+
+    for _ in range(cycles):
+        clock.now += CYCLE_TIME
+        snapshot = LocationSnapshot.fetch(provider, need_devices=True, last_known=last_known)
+        for trackee in trackees:
+            handle(trackee, snapshot, notifier)
+    del snapshot
+    gc.collect()
+    steady = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (built - base) / trackees_n, (steady - base) / trackees_n
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Memory held per trackee.")
+    parser.add_argument('--trackees', type=int, default=100)
+    parser.add_argument('--cycles', type=int, default=LOG_CAPACITY,
+                        help="poll cycles to run, enough to fill every log by default")
+    args = parser.parse_args(argv)
+
+    built, steady = run(args.trackees, args.cycles)
+    print(f"{args.trackees} trackees, {args.cycles} cycles")
+    print(f"  after setup:       {built / 1024:8.1f} KB per trackee")
+    print(f"  after the cycles:  {steady / 1024:8.1f} KB per trackee")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Benchmarks the poll cycle (every location new, and only a tenth of them
+new), distance math, trackee logging and the window refresh with
+1/10/100/1000 trackees against the simulated provider, and writes the
+results as JSON so runs can be compared between versions.
+
+Usage:
+    python benchmarks/suite.py --output results.json
+    python benchmarks/suite.py --compare results.json
+
+The update_ui benchmark needs PyQt5 and is skipped without it.
+"""
+
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from notifications import NotificationDispatcher
+from providers import SimulatedProvider
+from snapshot import LocationSnapshot
+from tracking import TrackingConfig, RuleGraph, handle, find_distance
+
+SIZES = [1, 10, 100, 1000]
+# seconds of simulated time between cycles
+CYCLE_TIME = 120
+# share of locations that are new each quiet_cycle, the rest are repeats
+QUIET_REPORT_RATE = 0.1
+
+
+class VirtualClock:
+    def __init__(self, now=1600000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def make_trackees(provider, n):
+    # half friends and half devices, every rule on, proximity to device 0
+    trackees = []
+    devices = provider.devices()
+    for friend in provider.friends()[:n - n // 2]:
+        trackees.append(TrackingConfig("friend", friend, friend['lastName']))
+    for device in devices[:n // 2]:
+        trackees.append(TrackingConfig("device", device, device['name']))
+    for trackee in trackees:
+        trackee.watch_movement = True
+        trackee.watch_proximity = True
+        trackee.proximity_to = devices[0]['id']
+        trackee.tolerance = 300.0
+    return trackees
+
+def setup_cycle(n, report_rate=1.0):
+    clock = VirtualClock()
+    provider = SimulatedProvider(devices=max(n // 2, 1), friends=n - n // 2, clock=clock,
+                                 report_rate=report_rate)
+    trackees = make_trackees(provider, n)
+    graph = RuleGraph()
+    for trackee in trackees:
+        graph.watch(trackee)
+    # nothing registered, posting only costs the dedup check
+    notifier = NotificationDispatcher()
+
+    def cycle():
+        clock.now += CYCLE_TIME
+        snapshot = LocationSnapshot.fetch(provider)
+        graph.evaluate(trackees, snapshot, notifier)
+    return cycle
+
+def setup_quiet_cycle(n):
+    # most devices haven't reported since the last poll
+    return setup_cycle(n, QUIET_REPORT_RATE)
+
+def setup_find_distance(n):
+    provider = SimulatedProvider(devices=n, friends=0)
+    locations = [device['location'] for device in provider.devices()]
+
+    def op():
+        for location in locations:
+            find_distance(locations[0], location)
+    return op
+
+def setup_log(n):
+    trackees = [TrackingConfig("device", {'id': str(i)}, str(i)) for i in range(n)]
+    location = {'latitude': 37.33, 'longitude': -122.03}
+
+    def op():
+        for trackee in trackees:
+            trackee.log(location=location, delta=12.5)
+            trackee.log("moved")
+    return op
+
+def setup_update_ui(n):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    import configparser
+
+    global qt_app
+    qt_app = QApplication.instance() or QApplication([])
+    spec = importlib.util.spec_from_file_location('tell_my', os.path.join(ROOT, 'Tell My.py'))
+    app_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app_module)
+    app_module.config = configparser.ConfigParser()
+    app_module.config_path = os.path.join(tempfile.mkdtemp(), 'data.ini')
+
+    clock = VirtualClock()
+    provider = SimulatedProvider(devices=max(n // 2, 1), friends=n - n // 2, clock=clock)
+    window = app_module.MainWindow(provider)
+    window.timer.stop()
+    # the catalog loads on the thread pool
+    while not window.catalog_ready:
+        qt_app.processEvents()
+        time.sleep(0.001)
+    for idx in range(n):
+        window.ui.availableDevicesBox.setCurrentIndex(idx)
+        window.addButtonClick()
+    window.ui.tracked.setCurrentRow(0)
+    notifier = NotificationDispatcher()
+
+    def op():
+        clock.now += CYCLE_TIME
+        snapshot = LocationSnapshot.fetch(provider)
+        for trackee in window.tracked:
+            handle(trackee, snapshot, notifier)
+        window.update_ui()
+        qt_app.processEvents()
+    return op
+
+BENCHMARKS = [
+    ('poll_cycle', setup_cycle),
+    ('quiet_cycle', setup_quiet_cycle),
+    ('find_distance', setup_find_distance),
+    ('trackee_log', setup_log),
+    ('update_ui', setup_update_ui),
+]
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+def peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos, kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def measure(name, setup, n, min_time):
+    try:
+        op = setup(n)
+    except ImportError as e:
+        return {'name': name, 'n': n, 'skipped': str(e)}
+
+    # warm up, then time until both enough runs and enough time have passed
+    op()
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < 5 or time.perf_counter() - started < min_time:
+        gc.collect()
+        begin = time.perf_counter()
+        op()
+        samples.append(time.perf_counter() - begin)
+        if len(samples) >= 10000:
+            break
+
+    # allocations are measured in separate runs, tracemalloc skews timings
+    tracemalloc.start()
+    runs = 5
+    blocks_before = sys.getallocatedblocks()
+    peak = 0
+    for _ in range(runs):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        op()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    retained = (sys.getallocatedblocks() - blocks_before) / runs
+    tracemalloc.stop()
+
+    total = sum(samples)
+    return {
+        'name': name,
+        'n': n,
+        'runs': len(samples),
+        'ops_per_sec': len(samples) / total,
+        'items_per_sec': len(samples) * n / total,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'peak_alloc_kb': peak / 1024.0,
+        'retained_blocks_per_run': retained,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, baseline=None):
+    previous = {}
+    if baseline:
+        previous = {(r['name'], r['n']): r for r in baseline['results'] if 'skipped' not in r}
+    print(f"{'benchmark':<14} {'n':>5} {'ops/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'peak KB':>9} {'rss KB':>9}"
+          + (f" {'p50 vs base':>12}" if baseline else ""))
+    for r in results:
+        if 'skipped' in r:
+            print(f"{r['name']:<14} {r['n']:>5} skipped: {r['skipped']}")
+            continue
+        line = (f"{r['name']:<14} {r['n']:>5} {r['ops_per_sec']:>10.1f} {r['p50_ms']:>10.3f} "
+                f"{r['p99_ms']:>10.3f} {r['peak_alloc_kb']:>9.1f} {r['peak_rss_kb'] or 0:>9}")
+        old = previous.get((r['name'], r['n']))
+        if old:
+            line += f" {r['p50_ms'] / old['p50_ms']:>11.2f}x"
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tell My benchmark suite.")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--only', action='append', help="run just these benchmarks")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--min-time', type=float, default=1.0, help="seconds to spend timing each case")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, setup in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        for n in args.sizes:
+            results.append(measure(name, setup, n, args.min_time))
+
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
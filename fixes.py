@@ -0,0 +1,11 @@
+import time
+
+
+def fix_timestamp(location):
+    # icloud reports milliseconds, as timeStamp on devices and timestamp on
+    # friends. snapshots fetched with a LastKnownGood fill in a missing one,
+    # anything else without one is taken as current
+    stamp = location.get('timeStamp') or location.get('timestamp')
+    if not stamp:
+        return time.time()
+    return stamp / 1000.0
@@ -0,0 +1,56 @@
+from math import sqrt, radians, sin, cos, atan2, pi
+
+# numpy is imported by the array functions that need it, the scalar ones are
+# on startup paths that shouldn't pay for it
+EARTH_RADIUS = 6371000.0
+# meters per degree of latitude on the same sphere haversine() uses
+METERS_PER_DEGREE = EARTH_RADIUS * pi / 180.0
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    # great-circle distance in meters between two points
+    dLat = radians(lat2-lat1)
+    dLng = radians(lng2-lng1)
+    a = sin(dLat/2) * sin(dLat/2) + \
+        cos(radians(lat1)) * cos(radians(lat2)) * \
+        sin(dLng/2) * sin(dLng/2)
+    c = 2 * atan2(sqrt(a), sqrt(1-a))
+
+    return EARTH_RADIUS * c
+
+def _haversine_array(lat1, lng1, lat2, lng2):
+    # same formula as haversine(), broadcast over numpy arrays of degrees
+    import numpy as np
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dLat = lat2 - lat1
+    dLng = np.radians(lng2) - np.radians(lng1)
+    a = np.sin(dLat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dLng/2)**2
+    # rounding can push a a hair outside [0, 1] for antipodal points
+    a = np.clip(a, 0.0, 1.0)
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
+    return EARTH_RADIUS * c
+
+def paired_distances(lats1, lngs1, lats2, lngs2):
+    # distance between the i-th point of the first set and the i-th point of the second
+    import numpy as np
+    return _haversine_array(np.asarray(lats1, dtype=float), np.asarray(lngs1, dtype=float),
+                            np.asarray(lats2, dtype=float), np.asarray(lngs2, dtype=float))
+
+def distance_matrix(lats1, lngs1, lats2=None, lngs2=None):
+    # (n, m) matrix of distances from every point in the first set to every
+    # point in the second. with no second set, all pairs within the first
+    import numpy as np
+    lats1 = np.asarray(lats1, dtype=float)
+    lngs1 = np.asarray(lngs1, dtype=float)
+    if lats2 is None:
+        lats2, lngs2 = lats1, lngs1
+    else:
+        lats2 = np.asarray(lats2, dtype=float)
+        lngs2 = np.asarray(lngs2, dtype=float)
+    return _haversine_array(lats1[:, None], lngs1[:, None], lats2[None, :], lngs2[None, :])
+
+def within_distance(lats1, lngs1, lats2=None, lngs2=None, distance=500.0):
+    # boolean (n, m) mask of the pairs closer than distance meters
+    return distance_matrix(lats1, lngs1, lats2, lngs2) < distance
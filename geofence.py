@@ -0,0 +1,176 @@
+from math import cos, radians
+
+import numpy as np
+
+from fixes import fix_timestamp
+from geodesic import haversine, _haversine_array, METERS_PER_DEGREE
+
+ENTER = 'enter'
+EXIT = 'exit'
+DWELL = 'dwell'
+
+
+class Zone:
+    # a named area, either a circle (center (lat, lng) and radius in meters)
+    # or a polygon [(lat, lng), ...]. dwell is how many seconds inside it
+    # count as staying there, None for no dwell event. polygons crossing the
+    # antimeridian aren't supported
+    def __init__(self, name, center=None, radius=None, polygon=None, dwell=None):
+        if (center is None) == (polygon is None):
+            raise ValueError(f"zone {name!r} needs either a center and radius or a polygon")
+        if polygon is not None and len(polygon) < 3:
+            raise ValueError(f"zone {name!r} needs at least three polygon points")
+        self.name = name
+        self.center = center
+        self.radius = radius
+        self.polygon = polygon
+        self.dwell = dwell
+
+    def bounds(self):
+        # (min_lat, max_lat, min_lng, max_lng)
+        if self.polygon is not None:
+            lats, lngs = zip(*self.polygon)
+            return min(lats), max(lats), min(lngs), max(lngs)
+        lat, lng = self.center
+        dlat = self.radius / METERS_PER_DEGREE
+        # widest at the pole-ward edge of the circle
+        dlng = self.radius / (METERS_PER_DEGREE * max(cos(radians(min(abs(lat) + dlat, 90.0))), 1e-9))
+        return lat - dlat, lat + dlat, lng - dlng, lng + dlng
+
+
+class ZoneSet:
+    # the zones one trackee watches, laid out as arrays so a fix is tested
+    # against all of them at once. bounding boxes rule most zones out, then
+    # circles are one vectorized haversine and only the polygons whose box
+    # holds the fix get a point-in-polygon test
+    def __init__(self, zones):
+        self.zones = list(zones)
+        bounds = np.array([zone.bounds() for zone in self.zones], dtype=float).reshape(-1, 4)
+        self.min_lat, self.max_lat, self.min_lng, self.max_lng = bounds.T
+        self.circles = np.array([zone.polygon is None for zone in self.zones], dtype=bool)
+        self.circle_idx = np.flatnonzero(self.circles)
+        self.circle_lat = np.array([self.zones[i].center[0] for i in self.circle_idx], dtype=float)
+        self.circle_lng = np.array([self.zones[i].center[1] for i in self.circle_idx], dtype=float)
+        self.circle_radius = np.array([self.zones[i].radius for i in self.circle_idx], dtype=float)
+        # each polygon as its edges, (lat1, lng1, lat2, lng2) arrays
+        self.polygons = {i: polygon_edges(zone.polygon)
+                         for i, zone in enumerate(self.zones) if zone.polygon is not None}
+
+    def __len__(self):
+        return len(self.zones)
+
+    def evaluate(self, lat, lng):
+        # (inside, margin): a bool array over the zones and how many meters
+        # the point is from the nearest zone edge, never more than the truth
+        inside = np.zeros(len(self.zones), dtype=bool)
+        if not self.zones:
+            return inside, None
+        in_box = ((self.min_lat <= lat) & (lat <= self.max_lat) &
+                  (self.min_lng <= lng) & (lng <= self.max_lng))
+        margins = []
+
+        if len(self.circle_idx):
+            dist = _haversine_array(lat, lng, self.circle_lat, self.circle_lng)
+            inside[self.circle_idx] = dist < self.circle_radius
+            margins.append(np.abs(dist - self.circle_radius).min())
+
+        if self.polygons:
+            meters_per_lng = METERS_PER_DEGREE * max(cos(radians(lat)), 1e-9)
+            # distance to a box is a lower bound on the distance to its polygon
+            dlat = np.maximum(np.maximum(self.min_lat - lat, lat - self.max_lat), 0.0) * METERS_PER_DEGREE
+            dlng = np.maximum(np.maximum(self.min_lng - lng, lng - self.max_lng), 0.0) * meters_per_lng
+            outside = ~in_box & ~self.circles
+            if outside.any():
+                margins.append(np.hypot(dlat[outside], dlng[outside]).min())
+            for i in np.flatnonzero(in_box & ~self.circles):
+                edges = self.polygons[i]
+                inside[i] = point_in_polygon(lat, lng, edges)
+                margins.append(edge_distance(lat, lng, edges, meters_per_lng))
+        return inside, float(min(margins))
+
+
+class Geofence:
+    # one trackee's zones plus which it was inside at the last fix, so only
+    # crossings turn into events. the first fix only sets the state, starting
+    # up at home isn't arriving home. nothing can have been crossed while
+    # the trackee stays within the last margin of where the zones were last
+    # evaluated, so most fixes skip the evaluation altogether
+    def __init__(self, zones):
+        self.zones = zones if isinstance(zones, ZoneSet) else ZoneSet(zones)
+        self.inside = None
+        # zone index -> when a dwell event is due, for zones it's inside
+        self.dwell_due = {}
+        self.margin = None
+        self.evaluated_at = None
+        self.evaluated_margin = 0.0
+
+    def update(self, location):
+        # [(ENTER | EXIT | DWELL, zone)] caused by this fix
+        timestamp = fix_timestamp(location)
+        lat = location['latitude']
+        lng = location['longitude']
+        if self.evaluated_at is not None:
+            moved = haversine(self.evaluated_at[0], self.evaluated_at[1], lat, lng)
+            if moved < self.evaluated_margin:
+                self.margin = self.evaluated_margin - moved
+                return self.dwelled(timestamp)
+
+        inside, self.margin = self.zones.evaluate(lat, lng)
+        self.evaluated_at = (lat, lng)
+        self.evaluated_margin = self.margin or 0.0
+        inside = set(np.flatnonzero(inside).tolist())
+        if self.inside is None:
+            self.inside = inside
+            for i in inside:
+                self.expect_dwell(i, timestamp)
+            return []
+
+        events = []
+        for i in sorted(inside - self.inside):
+            events.append((ENTER, self.zones.zones[i]))
+            self.expect_dwell(i, timestamp)
+        for i in sorted(self.inside - inside):
+            events.append((EXIT, self.zones.zones[i]))
+            self.dwell_due.pop(i, None)
+        self.inside = inside
+        return events + self.dwelled(timestamp)
+
+    def expect_dwell(self, i, entered):
+        dwell = self.zones.zones[i].dwell
+        if dwell is not None:
+            self.dwell_due[i] = entered + dwell
+
+    def dwelled(self, timestamp):
+        if not self.dwell_due:
+            return []
+        done = [i for i, due in self.dwell_due.items() if timestamp >= due]
+        for i in done:
+            del self.dwell_due[i]
+        return [(DWELL, self.zones.zones[i]) for i in sorted(done)]
+
+
+def polygon_edges(polygon):
+    lat1, lng1 = np.array(polygon, dtype=float).T
+    return lat1, lng1, np.roll(lat1, -1), np.roll(lng1, -1)
+
+def point_in_polygon(lat, lng, edges):
+    # even-odd ray casting over all edges at once
+    lat1, lng1, lat2, lng2 = edges
+    crosses = (lat1 > lat) != (lat2 > lat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        at = lng1 + (lat - lat1) * (lng2 - lng1) / (lat2 - lat1)
+    return bool(np.count_nonzero(crosses & (lng < at)) % 2)
+
+def edge_distance(lat, lng, edges, meters_per_lng):
+    # meters to the nearest polygon edge, flat earth around the point which
+    # is plenty for zones a few km across
+    lat1, lng1, lat2, lng2 = edges
+    y = (lat1 - lat) * METERS_PER_DEGREE
+    x = (lng1 - lng) * meters_per_lng
+    dy = (lat2 - lat1) * METERS_PER_DEGREE
+    dx = (lng2 - lng1) * meters_per_lng
+    length = dx*dx + dy*dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(length > 0, -(x*dx + y*dy) / length, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return float(np.hypot(x + t*dx, y + t*dy).min())
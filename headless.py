@@ -0,0 +1,429 @@
+"""
+Runs the tracker without a window, for servers with no display. Trackees and
+rules come from an INI file, and nothing from PyQt5 is imported.
+
+Usage:
+    python headless.py --config trackees.ini
+
+    # offline against simulated devices and friends, tracking all of them
+    # unless a config is given
+    python headless.py --simulate 1000 --latency 0.5 --error-rate 0.01
+
+Example config:
+
+    [account]
+    username = abc@xyd.com
+    # or set TELL_MY_PASSWORD, otherwise the keyring is tried and then it's
+    # prompted for
+    passwd = password
+
+    # more accounts, their devices and friends are tracked side by side
+    [account:work]
+    username = def@xyd.com
+
+    [trackee:mom]
+    # a friend's "first last" name or a device name
+    name = Jane Doe
+    watch_movement = yes
+    tolerance = 500
+    watch_movement_audio = no
+    # device names to show alerts on
+    watch_movement_device = Dad's iPhone
+    watch_proximity = yes
+    proximity_to = Dad's iPhone
+    distance = 500
+    # alert on entering and leaving these [zone:...] sections
+    zones = home, school
+    zones_audio = no
+    zones_device = Dad's iPhone
+
+    [zone:home]
+    center = 37.3349, -122.0090
+    # meters
+    radius = 150
+    # alert again after staying this many seconds, optional
+    dwell = 600
+
+    [zone:school]
+    # lat lng corners in order
+    polygon = 37.336 -122.012, 37.338 -122.012, 37.338 -122.008, 37.336 -122.008
+
+    [group:family]
+    # alert when any two members come within distance of each other
+    members = mom, dad
+    distance = 200
+"""
+
+import argparse
+import configparser
+import getpass
+import os
+import signal
+import sys
+import threading
+
+from appdirs import user_data_dir
+
+from history import LocationHistory
+from metrics import metrics
+from notifications import default_dispatcher
+from push_server import PushServer
+from providers import ICloudProvider, SimulatedProvider, AccountsProvider
+from resilience import ResilientProvider
+import session_cache
+from session_cache import SessionCache, get_password, REFRESH_INTERVAL
+from scheduler import PollScheduler, next_interval, COALESCE_WINDOW
+from snapshot import LocationSnapshot, LastKnownGood
+from spatial_index import ProximityWatcher
+from tracking import TrackingConfig, RuleGraph, needed_fetches, format_log_entry, alert
+
+DEFAULT_CONFIG = os.path.join(user_data_dir('Tell My', 'cw'), 'trackees.ini')
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Daemon:
+    def __init__(self, provider, trackees, groups, data_dir, metrics_path=None, push=None):
+        self.provider = provider
+        self.push = push
+        self.last_known = LastKnownGood()
+        self.metrics_path = metrics_path
+        self.trackees = trackees
+        self.groups = groups
+        self.history = LocationHistory(os.path.join(data_dir, 'history.db'))
+        self.notifier = default_dispatcher(os.path.join(data_dir, 'alerts.log'))
+        if push is not None:
+            self.notifier.register('log', push.alert_sink())
+        self.scheduler = PollScheduler()
+        self.stopped = threading.Event()
+        self.printed = {}
+        self.graph = RuleGraph()
+        for trackee in self.trackees.values():
+            self.graph.watch(trackee)
+            self.scheduler.schedule(trackee, 0)
+
+    def run(self, once=False):
+        while not self.stopped.is_set():
+            wait = self.scheduler.next_due()
+            if wait is None:
+                return
+            if wait > 0:
+                self.stopped.wait(wait)
+                continue
+            self.cycle(self.scheduler.pop_due(COALESCE_WINDOW))
+            if once:
+                return
+
+    def stop(self, *args):
+        self.stopped.set()
+
+    def close(self):
+        self.notifier.close(timeout=5)
+        if self.push is not None:
+            self.push.stop()
+        self.history.close()
+
+    def cycle(self, due):
+        with metrics.span('locate'):
+            self.locate(due)
+        metrics.count('cycles')
+        metrics.export(self.metrics_path)
+
+    def locate(self, due):
+        need_friends, need_devices = needed_fetches(due)
+        if self.groups:
+            need_friends = need_friends or any(t.type == "friend" for t in self.trackees.values())
+            need_devices = need_devices or any(t.type == "device" for t in self.trackees.values())
+        self.scheduler.spend(need_friends + need_devices)
+        snapshot = LocationSnapshot.fetch(self.provider, need_friends, need_devices, self.last_known)
+        try:
+            self.history.append((t.id, snapshot.location(t)) for t in due)
+        except Exception as e:
+            print(f"failed to save location history: {e}")
+
+        self.graph.evaluate(due, snapshot, self.notifier)
+        for trackee in due:
+            trackee.poll_interval = next_interval(trackee.poll_interval, trackee.speed, trackee.margin)
+            self.scheduler.schedule(trackee, trackee.poll_interval)
+            self.print_log(trackee)
+        if self.push is not None:
+            self.push.publish(due)
+
+        for group in self.groups:
+            group.update(snapshot, self.notifier)
+        sys.stdout.flush()
+
+    def print_log(self, trackee):
+        # only what was logged since the last cycle
+        new = trackee.log_count - self.printed.get(trackee, 0)
+        if new > 0:
+            for entry in trackee.log_entries.tail(new):
+                print(f"{trackee.display_name}: {format_log_entry(entry)}")
+        self.printed[trackee] = trackee.log_count
+
+
+class ProximityGroup:
+    # many-to-many proximity between the members of a group
+    def __init__(self, name, members, distance, audio=False):
+        self.name = name
+        self.members = {member.id: member for member in members}
+        self.audio = audio
+        self.watcher = ProximityWatcher(distance)
+
+    def update(self, snapshot, notifier):
+        positions = {key: position for key, position in snapshot.positions().items()
+                     if key in self.members}
+        entered, _ = self.watcher.update(positions)
+        for pair in entered:
+            first, second = sorted(self.members[key].display_name for key in pair)
+            alert(notifier, 'Proximity Detected', f"{first} is near {second}", self.audio, None)
+            print(f"{self.name}: {first} is near {second}")
+
+
+def load_config(path):
+    parser = configparser.ConfigParser()
+    if not parser.read(path):
+        raise ConfigError(f"can't read config file {path}")
+    return parser
+
+def sign_in(parser, section, session):
+    username = session.username
+    # the environment only holds one password, for the main account
+    password = ((section == 'account' and os.environ.get('TELL_MY_PASSWORD'))
+                or parser.get(section, 'passwd', fallback=None) or get_password(username))
+    if not password:
+        password = getpass.getpass(f"iCloud password for {username}: ")
+
+    # with a cached, trusted session this skips both the full sign in and 2fa
+    api = session_cache.sign_in(username, password, session)
+    if api.requires_2fa:
+        if not sys.stdin.isatty():
+            raise ConfigError("two factor code required, run once interactively to trust this machine")
+        code = input(f"Two factor code for {username}: ")
+        if not api.validate_2fa_code(code):
+            raise ConfigError("two factor code failed")
+    elif api.requires_2sa:
+        raise ConfigError("your account doesn't support 2fa")
+    session.save()
+    return api
+
+def keep_session_fresh(api, session, stopped):
+    while not stopped.wait(REFRESH_INTERVAL):
+        try:
+            session_cache.refresh(api, session)
+        except Exception as e:
+            print(f"failed to refresh session: {e}")
+
+def build_trackees(parser, provider):
+    devices = provider.devices()
+    friends = provider.friends()
+    device_index = {}
+    for idx, device in enumerate(devices):
+        device_index[device['name']] = idx
+        device_index[f'{device["name"]} ({device["deviceDisplayName"]})'] = idx
+    friend_index = {f'{x["firstName"]} {x["lastName"]}': x for x in friends}
+
+    def find_device(section, key):
+        name = parser.get(section, key)
+        if name not in device_index:
+            raise ConfigError(f"[{section}] {key}: no device named {name!r}")
+        return devices[device_index[name]]['id']
+
+    zones = build_zones(parser)
+    trackees = {}
+    for section in parser.sections():
+        if not section.startswith('trackee:'):
+            continue
+        name = parser.get(section, 'name', fallback=section.split(':', 1)[1])
+        if name in friend_index:
+            trackee = TrackingConfig("friend", friend_index[name], name)
+        elif name in device_index:
+            trackee = TrackingConfig("device", devices[device_index[name]], name)
+        else:
+            raise ConfigError(f"[{section}] no friend or device named {name!r}")
+
+        trackee.watch_movement = parser.getboolean(section, 'watch_movement', fallback=False)
+        trackee.tolerance = parser.getfloat(section, 'tolerance', fallback=trackee.tolerance)
+        trackee.watch_movement_audio = parser.getboolean(section, 'watch_movement_audio', fallback=False)
+        if parser.has_option(section, 'watch_movement_device'):
+            trackee.watch_movement_device_cb = True
+            trackee.watch_movement_device_adb = find_device(section, 'watch_movement_device')
+
+        trackee.watch_proximity = parser.getboolean(section, 'watch_proximity', fallback=False)
+        if trackee.watch_proximity:
+            trackee.proximity_to = find_device(section, 'proximity_to')
+        trackee.distance = parser.getfloat(section, 'distance', fallback=trackee.distance)
+        trackee.watch_proximity_audio = parser.getboolean(section, 'watch_proximity_audio', fallback=False)
+        if parser.has_option(section, 'watch_proximity_device'):
+            trackee.watch_proximity_device_cb = True
+            trackee.watch_proximity_device_adb = find_device(section, 'watch_proximity_device')
+
+        if parser.has_option(section, 'zones'):
+            watched = []
+            for key in parser.get(section, 'zones').split(','):
+                key = key.strip()
+                if key not in zones:
+                    raise ConfigError(f"[{section}] zones: no zone section named {key!r}")
+                watched.append(zones[key])
+            from geofence import Geofence
+            trackee.geofence = Geofence(watched)
+        trackee.watch_zones_audio = parser.getboolean(section, 'zones_audio', fallback=False)
+        if parser.has_option(section, 'zones_device'):
+            trackee.watch_zones_device_cb = True
+            trackee.watch_zones_device_adb = find_device(section, 'zones_device')
+
+        trackees[section.split(':', 1)[1]] = trackee
+    return trackees
+
+def build_zones(parser):
+    zones = {}
+    for section in parser.sections():
+        if not section.startswith('zone:'):
+            continue
+        # geofence brings in numpy, only configs with zones pay for it
+        from geofence import Zone
+        name = section.split(':', 1)[1]
+        dwell = parser.getfloat(section, 'dwell', fallback=None)
+        try:
+            if parser.has_option(section, 'polygon'):
+                polygon = [tuple(float(x) for x in point.split())
+                           for point in parser.get(section, 'polygon').split(',')]
+                zones[name] = Zone(name, polygon=polygon, dwell=dwell)
+            else:
+                lat, lng = (float(x) for x in parser.get(section, 'center').split(','))
+                zones[name] = Zone(name, center=(lat, lng), radius=parser.getfloat(section, 'radius'),
+                                   dwell=dwell)
+        except (ValueError, configparser.Error) as e:
+            raise ConfigError(f"[{section}] {e}")
+    return zones
+
+def track_everything(provider):
+    # every device and friend with default movement watching, for simulations
+    trackees = {}
+    for friend in provider.friends():
+        name = f'{friend["firstName"]} {friend["lastName"]}'
+        trackees[name] = TrackingConfig("friend", friend, name)
+    for device in provider.devices():
+        trackees[device['name']] = TrackingConfig("device", device, device['name'])
+    for trackee in trackees.values():
+        trackee.watch_movement = True
+    return trackees
+
+def build_groups(parser, trackees):
+    groups = []
+    for section in parser.sections():
+        if not section.startswith('group:'):
+            continue
+        members = []
+        for key in parser.get(section, 'members').split(','):
+            key = key.strip()
+            if key not in trackees:
+                raise ConfigError(f"[{section}] no trackee section named {key!r}")
+            members.append(trackees[key])
+        groups.append(ProximityGroup(section.split(':', 1)[1], members,
+                                     parser.getfloat(section, 'distance', fallback=500.0),
+                                     parser.getboolean(section, 'audio', fallback=False)))
+    return groups
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Track friends and devices without a window.")
+    arg_parser.add_argument('-c', '--config', default=DEFAULT_CONFIG, help="trackee and rule config file")
+    arg_parser.add_argument('--data-dir', default=user_data_dir('Tell My', 'cw'),
+                            help="where history.db and alerts.log are written")
+    arg_parser.add_argument('--metrics', metavar='PATH',
+                            help="export timings after every cycle, prometheus text for a .prom path, json lines otherwise")
+    arg_parser.add_argument('--serve', type=int, metavar='PORT',
+                            help="stream positions and alerts to local clients over http on this port")
+    arg_parser.add_argument('--serve-socket', metavar='PATH', help="same as --serve, on a unix socket")
+    arg_parser.add_argument('--once', action='store_true', help="run a single cycle and exit")
+    arg_parser.add_argument('--simulate', type=int, metavar='N',
+                            help="use N simulated devices and N simulated friends instead of icloud")
+    arg_parser.add_argument('--latency', type=float, default=0.0, help="simulated seconds per request")
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help="simulated request failure rate")
+    args = arg_parser.parse_args(argv)
+
+    # (api, session) of every signed in account
+    sessions = []
+    try:
+        if args.simulate is not None:
+            provider = ResilientProvider(SimulatedProvider(args.simulate, args.simulate, latency=args.latency,
+                                                           error_rate=args.error_rate))
+            if os.path.exists(args.config):
+                parser = load_config(args.config)
+                trackees = build_trackees(parser, provider)
+                groups = build_groups(parser, trackees)
+            else:
+                trackees = track_everything(provider)
+                groups = []
+        else:
+            parser = load_config(args.config)
+            accounts = {}
+            for section in parser.sections():
+                if section != 'account' and not section.startswith('account:'):
+                    continue
+                username = parser.get(section, 'username', fallback=None)
+                if not username:
+                    raise ConfigError(f"no username in [{section}]")
+                session = SessionCache(username)
+                try:
+                    api = sign_in(parser, section, session)
+                except BaseException:
+                    # a wrong password, 2fa or ^C at a prompt, nothing to cache
+                    session.discard()
+                    raise
+                sessions.append((api, session))
+                accounts[username] = ResilientProvider(ICloudProvider(api))
+            if not accounts:
+                raise ConfigError("no [account] section")
+            if len(accounts) == 1:
+                provider, = accounts.values()
+            else:
+                provider = AccountsProvider(accounts)
+            trackees = build_trackees(parser, provider)
+            groups = build_groups(parser, trackees)
+    except ConfigError as e:
+        print(f"error: {e}", file=sys.stderr)
+        for _, session in sessions:
+            session.close()
+        return 1
+    except BaseException:
+        # an account after the first failing to sign in
+        for _, session in sessions:
+            session.close()
+        raise
+    if not trackees:
+        print("error: nothing to track, add a [trackee:...] section", file=sys.stderr)
+        for _, session in sessions:
+            session.close()
+        return 1
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    if args.metrics:
+        metrics.enabled = True
+    push = None
+    if args.serve is not None or args.serve_socket:
+        try:
+            push = PushServer(args.serve, unix_path=args.serve_socket).start()
+        except OSError as e:
+            print(f"error: can't serve: {e}", file=sys.stderr)
+            for _, session in sessions:
+                session.close()
+            return 1
+    daemon = Daemon(provider, trackees, groups, args.data_dir, args.metrics, push)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    for api, session in sessions:
+        threading.Thread(target=keep_session_fresh, args=(api, session, daemon.stopped),
+                         daemon=True).start()
+    try:
+        daemon.run(once=args.once)
+    finally:
+        daemon.close()
+        for _, session in sessions:
+            session.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+import sqlite3
+import threading
+
+from fixes import fix_timestamp
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fixes (
+    trackee TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    accuracy REAL,
+    PRIMARY KEY (trackee, timestamp)
+) WITHOUT ROWID
+"""
+
+
+class LocationHistory:
+    # append-only store of every fix, one sqlite file in wal mode. rows are
+    # clustered by (trackee, timestamp) so time-range reads are index scans
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        # written from the locate worker, read from wherever
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def append(self, fixes):
+        # fixes is an iterable of (trackee, location) for one cycle, written
+        # in a single transaction. a fix icloud reports twice (same trackee
+        # and timestamp) is only stored once
+        rows = [fix_row(trackee, location) for trackee, location in fixes if location]
+        if not rows:
+            return 0
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO fixes VALUES (?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def query(self, trackee, start=None, end=None):
+        # [(timestamp, latitude, longitude, accuracy)] oldest first, start
+        # and end are unix times and either may be left open
+        sql = "SELECT timestamp, latitude, longitude, accuracy FROM fixes WHERE trackee = ?"
+        args = [trackee]
+        if start is not None:
+            sql += " AND timestamp >= ?"
+            args.append(start)
+        if end is not None:
+            sql += " AND timestamp < ?"
+            args.append(end)
+        sql += " ORDER BY timestamp"
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def latest(self, trackee):
+        with self.lock:
+            return self.db.execute(
+                "SELECT timestamp, latitude, longitude, accuracy FROM fixes "
+                "WHERE trackee = ? ORDER BY timestamp DESC LIMIT 1", (trackee,)).fetchone()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def fix_row(trackee, location):
+    return (trackee, fix_timestamp(location), location['latitude'], location['longitude'],
+            location.get('horizontalAccuracy'))
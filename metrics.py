@@ -0,0 +1,216 @@
+import builtins
+import json
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+# upper bounds in seconds, from a cheap distance calc up to a stalled fetch
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+PREFIX = 'tellmy_'
+# imports quicker than this, in seconds, are left out of the startup profile
+PROFILE_THRESHOLD = 0.001
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.last = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.last = value
+
+    def quantile(self, q):
+        # upper bound of the bucket the quantile falls in
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Span:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+
+class Metrics:
+    # counters and timing histograms for the tracking loop. everything is a
+    # no-op while disabled, spans cost one attribute check
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def span(self, name):
+        # with metrics.span('fetch_devices'): ... records the block's duration
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def timed(self, name):
+        # decorator version of span()
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with Span(self, name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def last(self, name):
+        histogram = self.histograms.get(name)
+        return histogram.last if histogram else None
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'time': time.time(),
+                'counters': dict(self.counters),
+                'histograms': {name: {'count': h.count, 'sum': h.sum, 'last': h.last,
+                                      'p50': h.quantile(0.5), 'p99': h.quantile(0.99)}
+                               for name, h in self.histograms.items()},
+            }
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {PREFIX}{name}_total counter")
+                lines.append(f"{PREFIX}{name}_total {value}")
+            for name, h in sorted(self.histograms.items()):
+                metric = f"{PREFIX}{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {h.count}')
+                lines.append(f"{metric}_sum {h.sum}")
+                lines.append(f"{metric}_count {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        # .prom files are rewritten in the prometheus text format (for the
+        # node exporter's textfile collector), anything else gets a json line
+        # appended
+        if not self.enabled or not path:
+            return
+        if path.endswith('.prom'):
+            tmp = f"{path}.tmp"
+            with open(tmp, 'w') as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp, path)
+        else:
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.snapshot()) + "\n")
+
+
+class StartupProfile:
+    # what --profile-startup prints: how long each import and each step up
+    # to a window took. an import is timed where the app's own code makes it,
+    # the modules it pulls in count towards it
+    def __init__(self, began=None):
+        self.began = time.perf_counter() if began is None else began
+        self.last = self.began
+        # (name, seconds) since the last report, imports and steps in order
+        self.entries = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.original_import = builtins.__import__
+
+    def watch_imports(self):
+        builtins.__import__ = self.timed_import
+        return self
+
+    def stop(self):
+        # imports after the last window go back to not being timed
+        if builtins.__import__ == self.timed_import:
+            builtins.__import__ = self.original_import
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules or getattr(self.local, 'depth', 0):
+            return self.original_import(name, globals, locals, fromlist, level)
+        self.local.depth = 1
+        started = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            self.local.depth = 0
+            with self.lock:
+                self.entries.append((f"import {name}", time.perf_counter() - started))
+
+    def mark(self, step):
+        # step took from the previous mark until now
+        now = time.perf_counter()
+        with self.lock:
+            self.entries.append((step, now - self.last))
+        self.last = now
+
+    def report(self, title, file=None):
+        # prints everything since the last report, slowest imports first
+        with self.lock:
+            entries, self.entries = self.entries, []
+        imports = sorted((e for e in entries if e[0].startswith('import ')), key=lambda e: -e[1])
+        steps = [e for e in entries if not e[0].startswith('import ')]
+        file = file or sys.stderr
+        print(f"{title}: {(time.perf_counter() - self.began) * 1000:.0f} ms since start", file=file)
+        for name, seconds in steps:
+            print(f"  {name:<36} {seconds * 1000:8.1f} ms", file=file)
+        if imports:
+            print(f"  imports, {sum(e[1] for e in imports) * 1000:.1f} ms in all:", file=file)
+            for name, seconds in imports:
+                if seconds >= PROFILE_THRESHOLD:
+                    print(f"    {name:<34} {seconds * 1000:8.1f} ms", file=file)
+
+
+metrics = Metrics(enabled=os.environ.get('TELL_MY_METRICS', '') not in ('', '0'))
@@ -0,0 +1,173 @@
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from metrics import metrics
+
+# seconds an identical notification is suppressed for after it's posted
+COALESCE_WINDOW = 60
+# minimum seconds between two sends on the same channel
+RATE_LIMITS = {
+    'desktop': 1,
+    'speech': 3,
+    'device': 10,
+    'log': 0,
+}
+# notifications waiting per channel before new ones are dropped
+QUEUE_SIZE = 100
+
+Notification = namedtuple('Notification', ['channel', 'title', 'message', 'target'])
+
+
+class Sink:
+    # delivers notifications for one channel, called from that channel's
+    # worker thread so it may block
+    def send(self, notification):
+        raise NotImplementedError
+
+
+class DesktopSink(Sink):
+    def send(self, notification):
+        script = 'display notification "{}" with title "{}"'.format(
+            _escape(notification.message), _escape(notification.title or ''))
+        subprocess.run(['osascript', '-e', script], check=False)
+
+
+class SpeechSink(Sink):
+    def send(self, notification):
+        subprocess.run(['say', notification.message], check=False)
+
+
+class DeviceSink(Sink):
+    # shows the message on the apple device passed as the notification target
+    def send(self, notification):
+        if notification.target is not None:
+            notification.target.display_message(subject="this doesnt get shown", message=notification.message, sounds=True)
+
+
+class LogSink(Sink):
+    # appends one line per notification to a file, works anywhere
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, notification):
+        line = f"{datetime.now():%Y-%m-%d %H:%M:%S} [{notification.channel}] "
+        if notification.title:
+            line += f"{notification.title}: "
+        with open(self.path, 'a') as f:
+            f.write(line + notification.message + "\n")
+
+
+class NotificationDispatcher:
+    # queues notifications so posting never blocks the caller. every channel
+    # has its own worker thread, so a slow or rate limited channel only
+    # delays itself, and identical notifications inside the coalesce window
+    # are sent once
+    def __init__(self, coalesce_window=COALESCE_WINDOW, rate_limits=RATE_LIMITS, clock=time.monotonic):
+        self.coalesce_window = coalesce_window
+        self.rate_limits = dict(rate_limits)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.recent = {}
+        self.channels = {}
+
+    def register(self, channel, sink):
+        # a channel may fan out to several sinks, they share its worker
+        with self.lock:
+            if channel not in self.channels:
+                worker = ChannelWorker(channel, self.rate_limits.get(channel, 0), self.clock)
+                self.channels[channel] = worker
+                worker.start()
+            self.channels[channel].sinks.append(sink)
+
+    def post(self, channel, title, message, target=None):
+        # returns False if the notification was coalesced or dropped
+        worker = self.channels.get(channel)
+        if worker is None:
+            return False
+        key = (channel, title, message, _target_key(target))
+        now = self.clock()
+        with self.lock:
+            last = self.recent.get(key)
+            if last is not None and now - last < self.coalesce_window:
+                metrics.count('alerts_coalesced')
+                return False
+            self.recent[key] = now
+            # forget keys that can no longer suppress anything
+            if len(self.recent) > 1000:
+                self.recent = {k: t for k, t in self.recent.items() if now - t < self.coalesce_window}
+        try:
+            worker.queue.put_nowait(Notification(channel, title, message, target))
+        except queue.Full:
+            print(f"dropped {channel} notification, queue full: {message}")
+            return False
+        return True
+
+    def close(self, timeout=None):
+        # lets every channel drain what's already queued, then stops them
+        for worker in self.channels.values():
+            worker.queue.put(None)
+        for worker in self.channels.values():
+            worker.join(timeout)
+
+
+class ChannelWorker(threading.Thread):
+    def __init__(self, channel, rate_limit, clock):
+        super(ChannelWorker, self).__init__(name=f"notify-{channel}", daemon=True)
+        self.channel = channel
+        self.rate_limit = rate_limit
+        self.clock = clock
+        self.sinks = []
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.last_sent = None
+        self.span_name = f"alert_{channel}"
+
+    def run(self):
+        while True:
+            notification = self.queue.get()
+            if notification is None:
+                return
+            if self.last_sent is not None:
+                wait = self.last_sent + self.rate_limit - self.clock()
+                if wait > 0:
+                    time.sleep(wait)
+            with metrics.span(self.span_name):
+                for sink in self.sinks:
+                    try:
+                        sink.send(notification)
+                    except Exception as e:
+                        print(f"failed to send {self.channel} notification: {e}")
+                        metrics.count('alert_errors')
+            metrics.count('alerts_sent')
+            self.last_sent = self.clock()
+
+
+def default_dispatcher(log_path=None):
+    # the desktop, speech and device channels, plus a log file if given.
+    # desktop and speech go through macos commands, anywhere else (a
+    # headless server) they're left out rather than failing every alert
+    dispatcher = NotificationDispatcher()
+    if sys.platform == 'darwin' and shutil.which('osascript'):
+        dispatcher.register('desktop', DesktopSink())
+    if sys.platform == 'darwin' and shutil.which('say'):
+        dispatcher.register('speech', SpeechSink())
+    dispatcher.register('device', DeviceSink())
+    if log_path:
+        dispatcher.register('log', LogSink(log_path))
+    return dispatcher
+
+def _escape(text):
+    return str(text).replace('\\', '\\\\').replace('"', '\\"')
+
+def _target_key(target):
+    if target is None:
+        return None
+    try:
+        return target['id']
+    except (KeyError, TypeError):
+        return id(target)
@@ -0,0 +1,265 @@
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from scheduler import RequestBudget, REQUEST_BUDGET
+
+# seconds before a single icloud request is abandoned
+REQUEST_TIMEOUT = 20.0
+# connections kept open to icloud, friends and devices are fetched side by side
+POOL_SIZE = 4
+# most account requests in flight at once, shared by every account
+ACCOUNT_WORKERS = 8
+
+
+class LocationProvider:
+    # where the tracker gets devices, friends and their locations from.
+    # devices are dict-like with id, name, deviceDisplayName and location
+    # keys, plus display_message(); friends are contact detail dicts
+    def devices(self):
+        raise NotImplementedError
+
+    def friends(self):
+        raise NotImplementedError
+
+    def friend_locations(self):
+        # [{'id': ..., 'location': {...}}] for every friend sharing with us
+        raise NotImplementedError
+
+    def stale(self, call):
+        # id -> seconds old of anything the last call of this name returned
+        # from an earlier fetch instead of a fresh one
+        return {}
+
+
+class ICloudProvider(LocationProvider):
+    # a signed in PyiCloudService. each call here is a full refresh of the
+    # corresponding icloud service
+    def __init__(self, api):
+        self.api = api
+        if getattr(api, 'session', None) is not None:
+            pool_session(api.session)
+
+    def devices(self):
+        return list(self.api.devices)
+
+    def friends(self):
+        return self.api.friends.contact_details
+
+    def friend_locations(self):
+        return self.api.friends.locations
+
+
+class AccountsProvider(LocationProvider):
+    # several signed in accounts behind one provider. every call fans out to
+    # all accounts on one shared pool and the results are merged, anything
+    # two accounts both see (family sharing) showing up once. each account
+    # has its own request budget, and an account that is over it or failing
+    # is served from its last good result so it doesn't blank the others.
+    # those items are reported by stale() with their age
+    def __init__(self, accounts, budget=REQUEST_BUDGET, workers=ACCOUNT_WORKERS, clock=time.monotonic):
+        # accounts is {name: provider}
+        self.accounts = dict(accounts)
+        self.clock = clock
+        self.budgets = {name: RequestBudget(budget, clock) for name in self.accounts}
+        self.executor = ThreadPoolExecutor(max_workers=min(workers, 2 * len(self.accounts)) or 1)
+        # (name, call) -> (result, when it was fetched)
+        self.last_good = {}
+        self.stale_items = {}
+
+    def devices(self):
+        return self.gather('devices')
+
+    def friends(self):
+        return self.gather('friends')
+
+    def friend_locations(self):
+        return self.gather('friend_locations')
+
+    def gather(self, call):
+        futures = {}
+        for name, provider in self.accounts.items():
+            budget = self.budgets[name]
+            if budget.wait() > 0:
+                continue
+            budget.spend()
+            futures[name] = self.executor.submit(getattr(provider, call))
+
+        merged = []
+        seen = set()
+        stale = {}
+        error = None
+        for name in self.accounts:
+            result = None
+            if name in futures:
+                try:
+                    result = futures[name].result()
+                except Exception as e:
+                    print(f"{name}: {call} failed: {e}")
+                    error = e
+            age = None
+            if result is None:
+                result, fetched = self.last_good.get((name, call), (None, None))
+                if result is not None:
+                    age = self.clock() - fetched
+            else:
+                self.last_good[(name, call)] = (result, self.clock())
+            for item in result or []:
+                if item['id'] not in seen:
+                    seen.add(item['id'])
+                    merged.append(item)
+                    if age is not None:
+                        stale[item['id']] = age
+        if not merged and error is not None:
+            raise error
+        self.stale_items[call] = stale
+        return merged
+
+    def stale(self, call):
+        return self.stale_items.get(call, {})
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def pool_session(session, timeout=REQUEST_TIMEOUT, pool_size=POOL_SIZE):
+    # keep a few connections to icloud open across cycles and never let a
+    # request hang for longer than timeout. session is the requests.Session
+    # pyicloud signs in with
+    from requests.adapters import HTTPAdapter
+
+    session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    request = session.request
+
+    def request_with_timeout(method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = timeout
+        return request(method, url, **kwargs)
+    session.request = request_with_timeout
+    return session
+
+
+class SimulatedError(Exception):
+    pass
+
+
+class SimulatedDevice(dict):
+    def __init__(self, provider, content):
+        super(SimulatedDevice, self).__init__(content)
+        self.provider = provider
+        self.messages = []
+
+    def location(self):
+        return self.provider.devices()[self.provider.device_ids[self['id']]]['location']
+
+    def display_message(self, subject, message, sounds=False):
+        self.provider.call()
+        self.messages.append(message)
+
+
+class SimulatedProvider(LocationProvider):
+    # deterministic stand in for icloud. every device and friend follows a
+    # synthetic trajectory, a loop around a home point at its own speed or
+    # sitting still, so positions only depend on the seed and the clock.
+    # latency and errors are injected per call for load testing. only
+    # report_rate of the locations are new on each call, the rest come back
+    # as the same fix as last time, like icloud between reports
+    def __init__(self, devices=100, friends=100, seed=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, missing_rate=0.0, moving=0.5, center=(37.33, -122.03),
+                 spread=20000.0, clock=time.time, report_rate=1.0):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.missing_rate = missing_rate
+        self.report_rate = report_rate
+        self.last_fixes = {}
+        self.clock = clock
+        self.calls = 0
+        self.errors = 0
+
+        self.trajectories = {}
+        self.device_content = []
+        self.device_ids = {}
+        for i in range(devices):
+            key = f'sim-device-{i}'
+            self.trajectories[key] = self._trajectory(center, spread, moving)
+            self.device_ids[key] = i
+            self.device_content.append({'id': key, 'name': f'Device {i}',
+                                        'deviceDisplayName': 'iPhone'})
+        self.contact_details = []
+        for i in range(friends):
+            key = f'sim-friend-{i}'
+            self.trajectories[key] = self._trajectory(center, spread, moving)
+            self.contact_details.append({'id': key, 'firstName': 'Friend', 'lastName': str(i)})
+
+        self.device_objects = [SimulatedDevice(self, content) for content in self.device_content]
+
+    def devices(self):
+        self.call()
+        now = self.clock()
+        for device in self.device_objects:
+            device['location'] = self.locate(device['id'], now, 'timeStamp')
+        return self.device_objects
+
+    def friends(self):
+        self.call()
+        return self.contact_details
+
+    def friend_locations(self):
+        self.call()
+        now = self.clock()
+        return [{'id': friend['id'], 'location': self.locate(friend['id'], now, 'timestamp')}
+                for friend in self.contact_details]
+
+    def position(self, key, now=None):
+        # (lat, lng) of an entity at a unix time, without the noise of a call
+        if now is None:
+            now = self.clock()
+        lat, lng, radius, period, phase = self.trajectories[key]
+        if not period:
+            return lat, lng
+        angle = phase + 2 * math.pi * now / period
+        north = radius * math.sin(angle)
+        east = radius * math.cos(angle)
+        return (lat + north / 111195.0,
+                lng + east / (111195.0 * math.cos(math.radians(lat))))
+
+    def locate(self, key, now, stamp_key):
+        with self.lock:
+            missing = self.rng.random() < self.missing_rate
+            reported = self.rng.random() < self.report_rate
+        if missing:
+            return None
+        if not reported and key in self.last_fixes:
+            return self.last_fixes[key]
+        lat, lng = self.position(key, now)
+        fix = self.last_fixes[key] = {'latitude': lat, 'longitude': lng, 'horizontalAccuracy': 65.0,
+                                      stamp_key: int(now * 1000)}
+        return fix
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            failed = self.rng.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise SimulatedError("simulated icloud failure")
+
+    def _trajectory(self, center, spread, moving):
+        # home point, loop radius in meters, seconds per loop (0 for still), phase
+        lat = center[0] + self.rng.uniform(-spread, spread) / 111195.0
+        lng = center[1] + self.rng.uniform(-spread, spread) / (111195.0 * math.cos(math.radians(center[0])))
+        if self.rng.random() >= moving:
+            return lat, lng, 0.0, 0.0, 0.0
+        radius = self.rng.uniform(200.0, 5000.0)
+        # walking to driving speeds
+        speed = self.rng.uniform(1.0, 30.0)
+        return lat, lng, radius, 2 * math.pi * radius / speed, self.rng.uniform(0, 2 * math.pi)
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from notifications import Sink
+
+DEFAULT_PORT = 8765
+# events a subscriber may have waiting before it's cut off. positions of
+# the same trackee replace each other while waiting, so only alerts pile up
+MAX_PENDING = 1000
+# seconds between keepalive comments on an idle event stream
+KEEPALIVE = 15
+
+
+class PushServer:
+    # serves what the tracker already fetched to other local tools, so none
+    # of them has to sign in and poll icloud themselves. runs its own event
+    # loop on a background thread and speaks plain http:
+    #
+    #   GET /state   latest position of every trackee, as json
+    #   GET /events  server-sent events: every trackee's latest position
+    #                first, then "position" events for positions that
+    #                changed and "alert" events as they fire
+    #
+    # on a tcp port bound to localhost, or a unix socket
+    def __init__(self, port=DEFAULT_PORT, host='127.0.0.1', unix_path=None):
+        self.port = port
+        self.host = host
+        self.unix_path = unix_path
+        self.states = {}
+        self.subscribers = set()
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.started = threading.Event()
+        self.error = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="push-server", daemon=True)
+        self.thread.start()
+        self.started.wait()
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            if self.unix_path:
+                start = asyncio.start_unix_server(self.handle, self.unix_path)
+            else:
+                start = asyncio.start_server(self.handle, self.host, self.port)
+            self.server = self.loop.run_until_complete(start)
+            if not self.unix_path:
+                # the real port when 0 asked for any free one
+                self.port = self.server.sockets[0].getsockname()[1]
+        except OSError as e:
+            self.error = e
+            self.started.set()
+            self.loop.close()
+            return
+        self.started.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(self.shutdown())
+        self.loop.close()
+
+    async def shutdown(self):
+        self.server.close()
+        for subscriber in list(self.subscribers):
+            subscriber.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        if self.loop is not None and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(5)
+
+    def publish(self, trackees):
+        # called from the poll cycle with the trackees it just handled
+        states = [state for state in map(trackee_state, trackees) if state is not None]
+        if states and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.update_states, states)
+
+    def publish_alert(self, title, message):
+        if self.loop is not None:
+            alert = {'title': title, 'message': message, 'time': time.time()}
+            self.loop.call_soon_threadsafe(self.broadcast, 'alert', alert, None)
+
+    def alert_sink(self):
+        # register on the dispatcher's log channel, every alert goes there once
+        return PushSink(self)
+
+    def update_states(self, states):
+        for state in states:
+            previous = self.states.get(state['id'])
+            if previous is not None and same_position(previous, state):
+                continue
+            self.states[state['id']] = state
+            self.broadcast('position', state, state['id'])
+
+    def broadcast(self, event, data, key):
+        payload = encode_event(event, data)
+        for subscriber in list(self.subscribers):
+            subscriber.push(key, payload)
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # headers aren't needed, just get past them
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            path = parts[1].split('?')[0] if len(parts) > 1 else ''
+            if len(parts) < 2 or parts[0] != 'GET':
+                await respond(writer, '405 Method Not Allowed', 'text/plain', b'only GET\n')
+            elif path == '/state':
+                body = json.dumps(list(self.states.values())).encode()
+                await respond(writer, '200 OK', 'application/json', body)
+            elif path == '/events':
+                await self.stream(writer)
+            else:
+                await respond(writer, '404 Not Found', 'text/plain', b'try /state or /events\n')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # shutting down, end this connection quietly
+            pass
+        finally:
+            writer.close()
+
+    async def stream(self, writer):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\nConnection: close\r\n\r\n')
+        subscriber = Subscriber(writer)
+        for key, state in self.states.items():
+            subscriber.push(key, encode_event('position', state))
+        self.subscribers.add(subscriber)
+        try:
+            await subscriber.run()
+        finally:
+            self.subscribers.discard(subscriber)
+
+
+class Subscriber:
+    # one /events client. events wait here until its socket takes them, a
+    # newer position replacing a waiting one of the same trackee, so a slow
+    # client gets the latest state late instead of every step of it
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = OrderedDict()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.counter = 0
+
+    def push(self, key, payload):
+        if self.closed:
+            return
+        if key is None:
+            # alerts all go through, each under its own key
+            self.counter += 1
+            key = ('alert', self.counter)
+        else:
+            self.pending.pop(key, None)
+        self.pending[key] = payload
+        if len(self.pending) > MAX_PENDING:
+            print("push client too slow, disconnecting it")
+            self.close()
+        self.ready.set()
+
+    def close(self):
+        # drop the connection rather than wait for it to take what's queued
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.clear()
+        self.writer.transport.abort()
+        self.ready.set()
+
+    async def run(self):
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.ready.wait(), KEEPALIVE)
+            except asyncio.TimeoutError:
+                self.writer.write(b': keepalive\n\n')
+            self.ready.clear()
+            while self.pending and not self.closed:
+                _, payload = self.pending.popitem(last=False)
+                self.writer.write(payload)
+                # waits while the client is behind, events meanwhile conflate
+                await self.writer.drain()
+
+
+class PushSink(Sink):
+    def __init__(self, server):
+        self.server = server
+
+    def send(self, notification):
+        self.server.publish_alert(notification.title, notification.message)
+
+
+def trackee_state(trackee):
+    location = trackee.track.location()
+    if location is None:
+        return None
+    return {
+        'id': trackee.id,
+        'name': trackee.display_name,
+        'latitude': location['latitude'],
+        'longitude': location['longitude'],
+        'accuracy': location['horizontalAccuracy'],
+        'timestamp': location['timeStamp'] / 1000.0,
+        'speed': trackee.speed,
+    }
+
+def same_position(a, b):
+    return (a['timestamp'] == b['timestamp'] and a['latitude'] == b['latitude'] and
+            a['longitude'] == b['longitude'] and a['name'] == b['name'])
+
+def encode_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+async def respond(writer, status, content_type, body):
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+    await writer.drain()
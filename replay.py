@@ -0,0 +1,308 @@
+"""
+Replays recorded location traces through the tracking rules on a virtual
+clock and reports every alert that would have fired, so tolerance, distance
+and zone changes can be checked against weeks of data in seconds. Nothing
+is sent anywhere.
+
+Usage:
+    python replay.py --config rules.ini history.db
+    python replay.py --config rules.ini trace.jsonl --set tolerance=300 --quiet
+
+    # poll like the live tracker instead of looking at every fix
+    python replay.py --config rules.ini history.db --poll
+
+    # convert a trace to the compact binary format, much faster to replay
+    python replay.py history.db --dump trace.fix
+
+Traces are read as a stream, in time order across trackees:
+
+    history.db      the sqlite file the tracker records, keyed by icloud id
+    *.jsonl         one {"trackee", "timestamp", "latitude", "longitude",
+                    "accuracy"} object per line, timestamp in unix seconds
+    anything else   the binary format written by --dump
+
+The config uses the [trackee:...] and [zone:...] sections of headless.py.
+name is the trackee's key in the trace unless the section sets id, which
+history.db needs since it's keyed by icloud id:
+
+    [trackee:mom]
+    name = Mom
+    id = ABC123...
+
+proximity_to and the alert device options name other trackees. Fixes of
+keys no trackee matches are counted and reported at the end.
+"""
+
+import argparse
+import configparser
+import heapq
+import json
+import math
+import os
+import sqlite3
+import struct
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+
+from headless import build_trackees, ConfigError
+from providers import LocationProvider
+from scheduler import next_interval
+from notifications import COALESCE_WINDOW
+from tracking import handle, TrackLog
+
+MAGIC = b'TMFX1\n'
+# trackee index, timestamp, latitude, longitude, accuracy (nan when unknown)
+RECORD = struct.Struct('<Idddf')
+# records read per chunk of a binary trace
+CHUNK = 4096
+# config options naming trackees, besides name
+TRACKEE_OPTIONS = ['proximity_to', 'watch_movement_device', 'watch_proximity_device', 'zones_device']
+
+
+def read_trace(path):
+    # yields (trackee, timestamp, latitude, longitude, accuracy)
+    if path.endswith('.db') or path.endswith('.sqlite'):
+        return read_history(path)
+    if path.endswith('.jsonl') or path.endswith('.json'):
+        return read_jsonl(path)
+    return read_binary(path)
+
+def read_history(path):
+    # each trackee's fixes come out of the primary key already in time
+    # order, merging those streams saves sorting the whole table
+    db = sqlite3.connect(path)
+    try:
+        streams = [db.execute("SELECT trackee, timestamp, latitude, longitude, accuracy "
+                              "FROM fixes WHERE trackee = ? ORDER BY timestamp", (trackee,))
+                   for trackee in history_trackees(db)]
+        yield from heapq.merge(*streams, key=lambda fix: fix[1])
+    finally:
+        db.close()
+
+def history_trackees(db):
+    # one index seek per trackee instead of scanning every row for DISTINCT
+    trackees = []
+    row = db.execute("SELECT min(trackee) FROM fixes").fetchone()
+    while row[0] is not None:
+        trackees.append(row[0])
+        row = db.execute("SELECT min(trackee) FROM fixes WHERE trackee > ?", (row[0],)).fetchone()
+    return trackees
+
+def read_jsonl(path):
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            fix = json.loads(line)
+            yield (fix['trackee'], fix['timestamp'], fix['latitude'], fix['longitude'],
+                   fix.get('accuracy'))
+
+def read_binary(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} isn't a trace file")
+        names = json.loads(f.readline())
+        while True:
+            chunk = f.read(RECORD.size * CHUNK)
+            if not chunk:
+                return
+            for idx, timestamp, lat, lng, accuracy in RECORD.iter_unpack(chunk):
+                yield names[idx], timestamp, lat, lng, None if math.isnan(accuracy) else accuracy
+
+def write_binary(fixes, path):
+    # the name table goes first, so names are collected in a first pass
+    # over a temporary file of records
+    names = {}
+    count = 0
+    try:
+        with open(path + '.records', 'wb') as records:
+            for trackee, timestamp, lat, lng, accuracy in fixes:
+                idx = names.setdefault(trackee, len(names))
+                records.write(RECORD.pack(idx, timestamp, lat, lng,
+                                          math.nan if accuracy is None else accuracy))
+                count += 1
+        with open(path, 'wb') as out, open(path + '.records', 'rb') as records:
+            out.write(MAGIC)
+            out.write(json.dumps(list(names)).encode() + b'\n')
+            while True:
+                chunk = records.read(1 << 20)
+                if not chunk:
+                    break
+                out.write(chunk)
+    finally:
+        if os.path.exists(path + '.records'):
+            os.remove(path + '.records')
+    return count
+
+
+class TraceProvider(LocationProvider):
+    # every trackee the config names, presented as devices so the headless
+    # config builder can resolve names and device options against them.
+    # keys maps each name to its key in the trace
+    def __init__(self, keys):
+        self.device_list = [{'id': key, 'name': name, 'deviceDisplayName': ''} for name, key in keys.items()]
+
+    def devices(self):
+        return self.device_list
+
+    def friends(self):
+        return []
+
+
+class ReplaySnapshot:
+    # the latest fix of every trackee as of the virtual clock, shaped like a
+    # LocationSnapshot for handle()
+    def __init__(self, devices):
+        self.devices = {device['id']: device for device in devices}
+        self.locations = {}
+
+    def location(self, config):
+        return self.locations.get(config.id)
+
+    def age(self, config):
+        return None
+
+    def device_age(self, device_id):
+        return None
+
+    def device(self, device_id):
+        return self.devices.get(device_id)
+
+    def device_location(self, device_id):
+        return self.locations.get(device_id)
+
+
+class ReplayNotifier:
+    # stands in for the dispatcher, collecting alerts at virtual time with
+    # the same coalescing of repeats the live dispatcher does
+    def __init__(self, report, coalesce_window=COALESCE_WINDOW):
+        self.report = report
+        self.coalesce_window = coalesce_window
+        self.now = 0.0
+        self.recent = {}
+
+    def post(self, channel, title, message, target=None):
+        # every alert is posted to the log channel exactly once
+        if channel != 'log':
+            return False
+        key = (title, message)
+        last = self.recent.get(key)
+        if last is not None and self.now - last < self.coalesce_window:
+            return False
+        self.recent[key] = self.now
+        self.report(self.now, title, message)
+        return True
+
+
+def replay(fixes, trackees, devices, report, poll=False):
+    # streams fixes through handle(), returns how many were read, how many
+    # of those were handled and a Counter of the fixes of keys nothing in
+    # the config names. memory stays at one latest fix and one filter per
+    # trackee
+    snapshot = ReplaySnapshot(devices)
+    notifier = ReplayNotifier(report)
+    by_key = {trackee.id: trackee for trackee in trackees}
+    next_poll = {}
+    unmatched = Counter()
+    read = handled = 0
+    for key, timestamp, lat, lng, accuracy in fixes:
+        read += 1
+        location = {'latitude': lat, 'longitude': lng, 'horizontalAccuracy': accuracy,
+                    'timeStamp': timestamp * 1000.0}
+        snapshot.locations[key] = location
+        trackee = by_key.get(key)
+        if trackee is None:
+            if key not in snapshot.devices:
+                unmatched[key] += 1
+            continue
+        if poll:
+            # the live tracker would only have seen this fix if it was due
+            if timestamp < next_poll.get(key, 0.0):
+                continue
+        notifier.now = timestamp
+        handle(trackee, snapshot, notifier)
+        handled += 1
+        if poll:
+            trackee.poll_interval = next_interval(trackee.poll_interval, trackee.speed, trackee.margin)
+            next_poll[key] = timestamp + trackee.poll_interval
+    return read, handled, unmatched
+
+def trace_keys(parser):
+    # name -> trace key of every trackee the config mentions
+    keys = {}
+    for section in parser.sections():
+        if not section.startswith('trackee:'):
+            continue
+        name = parser.get(section, 'name', fallback=section.split(':', 1)[1])
+        keys[name] = parser.get(section, 'id', fallback=name)
+        for option in TRACKEE_OPTIONS:
+            if parser.has_option(section, option):
+                keys.setdefault(parser.get(section, option), parser.get(section, option))
+    return keys
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Replay location traces through the tracking rules.")
+    arg_parser.add_argument('trace', help="history.db, a .jsonl trace or a binary trace")
+    arg_parser.add_argument('-c', '--config', help="trackee, rule and zone config file")
+    arg_parser.add_argument('--set', action='append', default=[], metavar='RULE=VALUE',
+                            help="override a rule for every trackee, e.g. tolerance=300")
+    arg_parser.add_argument('--poll', action='store_true',
+                            help="only look at fixes when the live tracker would have polled")
+    arg_parser.add_argument('--quiet', action='store_true', help="only print the summary")
+    arg_parser.add_argument('--dump', metavar='PATH', help="write the trace in the binary format and exit")
+    args = arg_parser.parse_args(argv)
+
+    if args.dump:
+        count = write_binary(read_trace(args.trace), args.dump)
+        print(f"wrote {count} fixes to {args.dump}")
+        return 0
+
+    if not args.config:
+        arg_parser.error("--config is required to replay")
+    parser = configparser.ConfigParser()
+    try:
+        if not parser.read(args.config):
+            raise ConfigError(f"can't read config file {args.config}")
+        for section in parser.sections():
+            if section.startswith('trackee:'):
+                for override in args.set:
+                    key, _, value = override.partition('=')
+                    parser.set(section, key.strip(), value.strip())
+        provider = TraceProvider(trace_keys(parser))
+        trackees = list(build_trackees(parser, provider).values())
+    except (ConfigError, configparser.Error) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    for trackee in trackees:
+        # nobody reads the log, keep just the latest entry
+        trackee.log_entries = TrackLog(1)
+
+    counts = Counter()
+
+    def report(now, title, message):
+        counts[title] += 1
+        if not args.quiet:
+            print(f"{datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')} {title}: {message}")
+
+    started = time.perf_counter()
+    try:
+        read, handled, unmatched = replay(read_trace(args.trace), trackees, provider.devices(), report, args.poll)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    elapsed = time.perf_counter() - started
+
+    print(f"{read} fixes, {handled} of tracked trackees, in {elapsed:.2f} s "
+          f"({read / max(elapsed, 1e-9) * 60 / 1e6:.1f}M fixes/min)")
+    for title, count in sorted(counts.items()):
+        print(f"  {title}: {count}")
+    if unmatched:
+        print(f"warning: {sum(unmatched.values())} fixes of {len(unmatched)} trace keys no trackee "
+              f"matches, e.g. {', '.join(map(repr, list(unmatched)[:3]))}. history.db is keyed by "
+              f"icloud id, set id in the trackee sections to match it", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+import random
+import threading
+import time
+
+from metrics import metrics
+from providers import LocationProvider
+
+# attempts per call before giving up on it for this cycle
+ATTEMPTS = 3
+# full jitter backoff between attempts, seconds
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+# failed calls in a row that open the circuit
+FAILURE_THRESHOLD = 3
+# how long an open circuit waits before letting a trial call through, doubled
+# every time the trial fails
+COOLDOWN = 30.0
+MAX_COOLDOWN = 900.0
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # stops calling something that keeps failing. closed lets every call
+    # through, after threshold failures in a row it opens and rejects calls
+    # without trying for a cooldown, then lets one trial call through
+    def __init__(self, threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN, max_cooldown=MAX_COOLDOWN,
+                 clock=time.monotonic):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.cooldown = cooldown
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+    def retry_in(self):
+        # seconds until the next trial call, 0 when calls go through
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - self.clock())
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or self.clock() < self.opened_at + self.cooldown:
+                return False
+            # half open, this caller is the trial
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        # returns True when this failure opened the circuit
+        with self.lock:
+            self.failures += 1
+            if self.trial:
+                # the trial failed, back off harder
+                self.trial = False
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self.opened_at = self.clock()
+                return False
+            if self.opened_at is None and self.failures >= self.threshold:
+                self.opened_at = self.clock()
+                return True
+            return False
+
+
+class ResilientProvider(LocationProvider):
+    # wraps another provider so each call is retried with jittered
+    # exponential backoff, and each endpoint has a circuit breaker. while an
+    # endpoint is down its calls fail at once instead of waiting out retries
+    # and timeouts every cycle. a call that returns None counts as failed
+    def __init__(self, provider, attempts=ATTEMPTS, backoff_base=BACKOFF_BASE, backoff_cap=BACKOFF_CAP,
+                 threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN, clock=time.monotonic,
+                 sleep=time.sleep, seed=None):
+        self.provider = provider
+        self.attempts = attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.sleep = sleep
+        self.rng = random.Random(seed)
+        self.breakers = {name: CircuitBreaker(threshold, cooldown, clock=clock)
+                         for name in ('devices', 'friends', 'friend_locations')}
+
+    def __getattr__(self, name):
+        # anything else, like .api, comes from the wrapped provider
+        return getattr(self.provider, name)
+
+    def devices(self):
+        return self.call('devices', self.provider.devices)
+
+    def friends(self):
+        return self.call('friends', self.provider.friends)
+
+    def friend_locations(self):
+        return self.call('friend_locations', self.provider.friend_locations)
+
+    def stale(self, call):
+        return self.provider.stale(call)
+
+    def retry_in(self):
+        # seconds until the soonest trial call while an endpoint is down,
+        # None while everything is up
+        waits = [breaker.retry_in() for breaker in self.breakers.values() if breaker.open]
+        return min(waits) if waits else None
+
+    def call(self, name, fn):
+        breaker = self.breakers[name]
+        if not breaker.allow():
+            metrics.count('circuit_rejected')
+            raise CircuitOpenError(f"{name} is failing, next try in {breaker.retry_in():.0f}s")
+        # a half open trial gets a single attempt
+        attempts = 1 if breaker.open else self.attempts
+        for attempt in range(attempts):
+            if attempt:
+                metrics.count('retries')
+                self.sleep(self.backoff(attempt))
+            try:
+                result = fn()
+            except Exception as e:
+                error = e
+                continue
+            if result is not None:
+                breaker.success()
+                return result
+            error = ValueError(f"{name} returned nothing")
+        if breaker.failure():
+            print(f"{name} failed {breaker.failures} times in a row, pausing for {breaker.cooldown:.0f}s")
+            metrics.count('circuit_opened')
+        raise error
+
+    def backoff(self, attempt):
+        # full jitter, uniformly up to base * 2^attempt
+        return self.rng.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
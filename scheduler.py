@@ -0,0 +1,118 @@
+import heapq
+import time
+from collections import deque
+
+DEFAULT_INTERVAL = 120
+MIN_INTERVAL = 30
+MAX_INTERVAL = 900
+# m/s below which a trackee counts as not moving, about walking pace / 3
+STATIONARY_SPEED = 0.5
+# icloud requests allowed per hour across every trackee
+REQUEST_BUDGET = 120
+# trackees due this soon are folded into the cycle that's about to run
+COALESCE_WINDOW = 15
+
+
+class PollScheduler:
+    # priority queue of trackees keyed by when each is next due to be polled,
+    # plus a RequestBudget to keep under
+    def __init__(self, budget=REQUEST_BUDGET, clock=time.monotonic):
+        self.clock = clock
+        self.queue = []
+        self.due = {}
+        self.budget = RequestBudget(budget, clock)
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.due)
+
+    def __contains__(self, key):
+        return key in self.due
+
+    def schedule(self, key, delay):
+        # (re)schedules key delay seconds from now, replacing any earlier entry
+        due = self.clock() + delay
+        self.due[key] = due
+        # the counter breaks ties so keys themselves are never compared
+        self.counter += 1
+        heapq.heappush(self.queue, (due, self.counter, key))
+
+    def remove(self, key):
+        # stale heap entries are skipped when they surface
+        self.due.pop(key, None)
+
+    def next_due(self):
+        # seconds until the next poll is due, including any wait the request
+        # budget imposes, or None if nothing is scheduled
+        self._drop_stale()
+        if not self.queue:
+            return None
+        return max(self.queue[0][0] - self.clock(), self.budget_wait(), 0.0)
+
+    def pop_due(self, window=0.0):
+        # every key due now, or within window seconds, since polls that share
+        # a fetch are cheaper together. nothing is due while over budget
+        if self.budget_wait() > 0:
+            return []
+        limit = self.clock() + window
+        due = []
+        while True:
+            self._drop_stale()
+            if not self.queue or self.queue[0][0] > limit:
+                return due
+            _, _, key = heapq.heappop(self.queue)
+            del self.due[key]
+            due.append(key)
+
+    def spend(self, requests=1):
+        self.budget.spend(requests)
+
+    def budget_wait(self):
+        return self.budget.wait()
+
+    def _drop_stale(self):
+        while self.queue:
+            due, _, key = self.queue[0]
+            if self.due.get(key) == due:
+                return
+            heapq.heappop(self.queue)
+
+
+class RequestBudget:
+    # sliding one-hour window of requests, at most limit of them
+    def __init__(self, limit=REQUEST_BUDGET, clock=time.monotonic):
+        self.limit = limit
+        self.clock = clock
+        self.requests = deque()
+
+    def spend(self, requests=1):
+        now = self.clock()
+        self.requests.extend([now] * requests)
+
+    def wait(self):
+        # seconds until another request fits in the budget
+        now = self.clock()
+        while self.requests and self.requests[0] <= now - 3600:
+            self.requests.popleft()
+        if len(self.requests) < self.limit:
+            return 0.0
+        return self.requests[len(self.requests) - self.limit] + 3600 - now
+
+
+def next_interval(previous, speed, margin):
+    # how long until a trackee should be polled again. speed is its latest
+    # estimate in m/s and margin how many meters it is from flipping a
+    # movement or proximity rule, either may be None when unknown
+    cap = MAX_INTERVAL
+    if margin is not None:
+        # poll twice before it could cover the distance to the threshold. a
+        # parked trackee can set off any moment, so it counts as walking
+        cap = max(MIN_INTERVAL, min(margin / max(speed or 0.0, STATIONARY_SPEED) / 2, MAX_INTERVAL))
+    if speed is None:
+        return min(DEFAULT_INTERVAL, cap)
+    if speed < STATIONARY_SPEED:
+        # not going anywhere, back off
+        return min(previous * 2, cap)
+    if margin is not None:
+        return cap
+    return max(MIN_INTERVAL, min(previous / 2, MAX_INTERVAL))
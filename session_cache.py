@@ -0,0 +1,134 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+PASSWORD_SERVICE = 'Tell My'
+SESSION_SERVICE = 'Tell My session'
+# re-validate the session this often, well inside apple's session lifetime
+REFRESH_INTERVAL = 30 * 60
+# each platform's own keyring, loaded directly rather than searched for
+PLATFORM_KEYRINGS = {
+    'darwin': 'keyring.backends.macOS.Keyring',
+    'win32': 'keyring.backends.Windows.WinVaultKeyring',
+    'linux': 'keyring.backends.SecretService.Keyring',
+}
+
+_keyring = None
+
+
+class SessionCache:
+    # pyicloud keeps its cookie jar and session tokens in a cookie directory.
+    # this gives it a private temporary one, filled from the keyring at start
+    # and written back after every sign in or refresh, so a restart can reuse
+    # the trusted session instead of doing a full sign in and 2fa
+    def __init__(self, username):
+        self.username = username
+        # mkdtemp creates it readable by this user only
+        self.directory = tempfile.mkdtemp(prefix='tell-my-session-')
+        self.restored = self.restore()
+
+    def restore(self):
+        # returns True if there was a session to restore
+        keyring = load_keyring()
+        try:
+            blob = keyring.get_password(SESSION_SERVICE, self.username)
+        except keyring.errors.KeyringError as e:
+            print(f"couldn't read cached session: {e}")
+            return False
+        if not blob:
+            return False
+        try:
+            files = json.loads(blob)
+        except ValueError:
+            return False
+        for name, contents in files.items():
+            # never trust a name from the keyring to stay in the directory
+            with open(os.path.join(self.directory, os.path.basename(name)), 'w') as f:
+                f.write(contents)
+        return bool(files)
+
+    def save(self):
+        files = {}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                with open(path) as f:
+                    files[name] = f.read()
+        keyring = load_keyring()
+        try:
+            keyring.set_password(SESSION_SERVICE, self.username, json.dumps(files))
+        except keyring.errors.KeyringError as e:
+            print(f"couldn't cache session: {e}")
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        keyring = load_keyring()
+        try:
+            keyring.delete_password(SESSION_SERVICE, self.username)
+        except keyring.errors.KeyringError:
+            pass
+
+    def close(self):
+        self.save()
+        self.discard()
+
+    def discard(self):
+        # removes the directory without caching it, for a session that never
+        # finished signing in and shouldn't replace a trusted one
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def load_keyring():
+    # importing keyring takes a while and letting it try every backend it
+    # knows takes longer, so neither happens until a password is needed and
+    # the platform's own backend is loaded directly. a backend set with
+    # PYTHON_KEYRING_BACKEND or keyringrc.cfg still wins
+    global _keyring
+    if _keyring is None:
+        import keyring
+        import keyring.core
+        import keyring.errors
+        if keyring.core.load_env() is None and keyring.core.load_config() is None:
+            name = PLATFORM_KEYRINGS.get(sys.platform)
+            try:
+                if name:
+                    keyring.set_keyring(keyring.core.load_keyring(name))
+            except Exception:
+                # not usable here (no secret service on a server, say),
+                # keyring falls back to searching
+                pass
+        _keyring = keyring
+    return _keyring
+
+def get_password(username):
+    if not username:
+        return None
+    keyring = load_keyring()
+    try:
+        return keyring.get_password(PASSWORD_SERVICE, username)
+    except keyring.errors.KeyringError as e:
+        print(f"couldn't read password from keyring: {e}")
+        return None
+
+def set_password(username, password):
+    # returns False if there's no usable keyring
+    keyring = load_keyring()
+    try:
+        keyring.set_password(PASSWORD_SERVICE, username, password)
+        return True
+    except keyring.errors.KeyringError as e:
+        print(f"couldn't save password to keyring: {e}")
+        return False
+
+def sign_in(username, password, cache):
+    # the pyicloud import is slow, only pay for it when signing in
+    from pyicloud import PyiCloudService
+    return PyiCloudService(username, password, cookie_directory=cache.directory)
+
+def refresh(api, cache):
+    # re-validates the session token, which also renews the cookies
+    api.authenticate()
+    cache.save()
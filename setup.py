@@ -12,7 +12,8 @@ APP = ['Tell My.py']
 DATA_FILES = []
 OPTIONS = {
     'iconfile': './assets/AppIcon.icns',
-    'includes': ['keyring.backends.kwallet', 'keyring.backends.OS_X', 'keyring.backends.SecretService', 'keyring.backends.Windows', 'pyicloud']
+    # py2app only builds for macos, session_cache loads this backend directly
+    'includes': ['keyring.backends.macOS', 'pyicloud']
 }
 
 setup(
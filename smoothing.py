@@ -0,0 +1,140 @@
+from math import sqrt, cos, radians
+
+from fixes import fix_timestamp
+from geodesic import METERS_PER_DEGREE
+
+# used for fixes that come without a horizontalAccuracy, in meters
+DEFAULT_ACCURACY = 100.0
+# how much a trackee is expected to speed up or slow down, in m^2/s^3.
+# small values trust the track, large ones trust each new fix
+PROCESS_NOISE = 0.001
+# squared normalized innovation beyond which a fix is treated as a jump,
+# 99.9% of a 2d gaussian
+OUTLIER_GATE = 13.8
+# this many outliers in a row means the trackee really did relocate
+MAX_REJECTS = 2
+# in meters, an outlier fix at least this accurate is the trackee leaving,
+# not a glitch, wifi jumps come with coarse accuracies
+TRUSTED_ACCURACY = 100.0
+# velocity uncertainty of a fresh track, (m/s)^2
+INITIAL_SPEED_VARIANCE = 100.0
+
+
+class TrackFilter:
+    # constant velocity kalman filter over one trackee's fixes. each fix is
+    # weighted by its horizontalAccuracy and the time since the previous one,
+    # so wifi jumps and gps jitter barely move the estimate while a real
+    # trip still pulls it along. the noise is the same on both axes, so one
+    # 2x2 covariance serves north and east and the state stays a handful of
+    # floats per trackee
+    __slots__ = ('process_noise', 'lat', 'lng', 'vn', 've', 'pp', 'pv', 'vv',
+                 'timestamp', 'updates', 'rejects')
+
+    def __init__(self, process_noise=PROCESS_NOISE):
+        self.process_noise = process_noise
+        self.lat = None
+        self.lng = None
+        # velocity in m/s, north and east
+        self.vn = 0.0
+        self.ve = 0.0
+        # covariance of (position, velocity) along either axis
+        self.pp = 0.0
+        self.pv = 0.0
+        self.vv = 0.0
+        self.timestamp = None
+        self.updates = 0
+        self.rejects = 0
+
+    def reset(self, lat, lng, accuracy, timestamp):
+        self.lat = lat
+        self.lng = lng
+        self.vn = 0.0
+        self.ve = 0.0
+        self.pp = accuracy * accuracy
+        self.pv = 0.0
+        self.vv = INITIAL_SPEED_VARIANCE
+        self.timestamp = timestamp
+        self.updates = 1
+        self.rejects = 0
+
+    def update(self, location):
+        # feed one icloud location dict, returns False when the fix was
+        # dropped as stale or as an outlier
+        timestamp = fix_timestamp(location)
+        accuracy = location.get('horizontalAccuracy') or DEFAULT_ACCURACY
+        lat = location['latitude']
+        lng = location['longitude']
+        if self.lat is None:
+            self.reset(lat, lng, accuracy, timestamp)
+            return True
+
+        dt = timestamp - self.timestamp
+        if dt <= 0:
+            # icloud hands back the same fix until the device reports again
+            return False
+
+        # predict
+        q = self.process_noise
+        pp = self.pp + 2*dt*self.pv + dt*dt*self.vv + q*dt*dt*dt/3
+        pv = self.pv + dt*self.vv + q*dt*dt/2
+        vv = self.vv + q*dt
+        meters_per_lng = METERS_PER_DEGREE * cos(radians(self.lat))
+        lat_pred = self.lat + self.vn*dt / METERS_PER_DEGREE
+        lng_pred = self.lng + self.ve*dt / meters_per_lng if meters_per_lng > 1e-9 else self.lng
+
+        # innovation in meters
+        dn = (lat - lat_pred) * METERS_PER_DEGREE
+        de = ((lng - lng_pred + 180.0) % 360.0 - 180.0) * meters_per_lng
+        s = pp + accuracy * accuracy
+        if (dn*dn + de*de) / s > OUTLIER_GATE:
+            if accuracy <= TRUSTED_ACCURACY:
+                # a precise fix that far off, start over from it already
+                # moving at the speed it took to get there
+                vn = (lat - self.lat) * METERS_PER_DEGREE / dt
+                ve = ((lng - self.lng + 180.0) % 360.0 - 180.0) * meters_per_lng / dt
+                self.reset(lat, lng, accuracy, timestamp)
+                self.vn = vn
+                self.ve = ve
+                self.updates = 2
+                return True
+            self.rejects += 1
+            if self.rejects < MAX_REJECTS:
+                return False
+            # not a glitch, it kept reporting from over there
+            self.reset(lat, lng, accuracy, timestamp)
+            return True
+
+        # correct
+        k_pos = pp / s
+        k_vel = pv / s
+        self.lat = lat_pred + k_pos*dn / METERS_PER_DEGREE
+        lng = lng_pred + k_pos*de / meters_per_lng if meters_per_lng > 1e-9 else lng_pred
+        self.lng = (lng + 180.0) % 360.0 - 180.0
+        self.vn += k_vel*dn
+        self.ve += k_vel*de
+        self.pp = (1 - k_pos) * pp
+        self.pv = (1 - k_pos) * pv
+        self.vv = vv - k_vel * pv
+        self.timestamp = timestamp
+        self.updates += 1
+        self.rejects = 0
+        return True
+
+    @property
+    def speed(self):
+        # m/s, None until there are two fixes to go on
+        if self.updates < 2:
+            return None
+        return sqrt(self.vn*self.vn + self.ve*self.ve)
+
+    @property
+    def accuracy(self):
+        # one sigma of the estimated position, in meters
+        return sqrt(self.pp)
+
+    def location(self):
+        # the estimate shaped like an icloud location, None before any fix
+        if self.lat is None:
+            return None
+        return {'latitude': self.lat, 'longitude': self.lng,
+                'horizontalAccuracy': self.accuracy, 'timeStamp': self.timestamp * 1000.0}
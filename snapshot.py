@@ -0,0 +1,240 @@
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from math import isnan, nan
+
+from metrics import metrics
+from resilience import CircuitOpenError
+
+
+class LocationSnapshot:
+    # every location known at one point in a poll cycle. friends and devices
+    # are each fetched once and served to all trackees from dicts keyed by id,
+    # instead of every trackee refreshing the whole icloud client itself.
+    # locations are copied into PositionTables, friend_locations may also be
+    # given as a dict of id -> icloud location
+    def __init__(self, friend_locations=None, devices=None, friends_age=None, devices_age=None, stale=None):
+        if not isinstance(friend_locations, PositionTable):
+            friend_locations = PositionTable((friend_locations or {}).items())
+        self.friend_locations = friend_locations
+        self.devices = devices or []
+        # seconds old when a fetch failed and the last known good result
+        # was used instead, None when fresh
+        self.friends_age = friends_age
+        self.devices_age = devices_age
+        # id -> seconds old of single entries a fresh fetch still served
+        # from an earlier one, like the devices of an account that's down
+        self.stale = stale or {}
+        self.device_locations = PositionTable()
+        self.device_index = {}
+        for idx, device in enumerate(self.devices):
+            self.device_index[device['id']] = idx
+            # pyicloud devices only have the key once they've reported one
+            try:
+                location = device['location']
+            except KeyError:
+                continue
+            self.device_locations.set(device['id'], location)
+
+    @classmethod
+    def fetch(cls, provider, need_friends=True, need_devices=True, last_known=None):
+        # with a LastKnownGood, a failed fetch falls back to the last result
+        # that came through
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            friends = executor.submit(fetch_friend_locations, provider) if need_friends else None
+            devices = executor.submit(fetch_devices, provider) if need_devices else None
+            friend_locations = friends.result() if friends else None
+            device_list = devices.result() if devices else None
+        friends_age = devices_age = None
+        if last_known is not None:
+            if need_friends:
+                friend_locations, friends_age = last_known.resolve('friends', friend_locations)
+            if need_devices:
+                device_list, devices_age = last_known.resolve('devices', device_list)
+        stale = {}
+        if need_friends and friends_age is None:
+            stale.update(provider.stale('friend_locations'))
+        if need_devices and devices_age is None:
+            stale.update(provider.stale('devices'))
+        snapshot = cls(friend_locations, device_list, friends_age, devices_age, stale)
+        if last_known is not None:
+            now = last_known.clock()
+            snapshot.friend_locations.fill_timestamps(last_known.stamps, now)
+            snapshot.device_locations.fill_timestamps(last_known.stamps, now)
+        return snapshot
+
+    def location(self, config):
+        if config.type == "friend":
+            return self.friend_locations.get(config.id)
+        return self.device_locations.get(config.id)
+
+    def has_location(self, config):
+        table = self.friend_locations if config.type == "friend" else self.device_locations
+        return config.id in table
+
+    def changed(self, versions):
+        # the ids in versions (id -> position version) whose fix here is a
+        # different one, versions is brought up to date. ids without a fix
+        # in this snapshot are left as they were
+        changed = []
+        for key, seen in versions.items():
+            version = self.friend_locations.version(key)
+            if version is None:
+                version = self.device_locations.version(key)
+            if version is not None and version != seen:
+                versions[key] = version
+                changed.append(key)
+        return changed
+
+    def age(self, config):
+        # how stale config's location is, None when it was fetched this cycle
+        age = self.friends_age if config.type == "friend" else self.devices_age
+        return age if age is not None else self.stale.get(config.id)
+
+    def device_age(self, device_id):
+        age = self.devices_age
+        return age if age is not None else self.stale.get(device_id)
+
+    def positions(self):
+        # id -> (lat, lng) of everything in the snapshot with a location,
+        # the shape GridIndex.update_snapshot() and ProximityWatcher take
+        positions = self.friend_locations.positions()
+        positions.update(self.device_locations.positions())
+        return positions
+
+    def device(self, device_id):
+        idx = self.device_index.get(device_id)
+        return self.devices[idx] if idx is not None else None
+
+    def device_location(self, device_id):
+        return self.device_locations.get(device_id)
+
+
+class PositionTable:
+    # the latest location of many entities as columns of doubles, each
+    # entity's row found through index. values are copied out of the icloud
+    # location dicts so the responses can be freed, and read back as small
+    # dicts of just the fields the rules use
+    def __init__(self, locations=()):
+        self.index = {}
+        self.latitude = array('d')
+        self.longitude = array('d')
+        # nan when icloud didn't report one
+        self.accuracy = array('d')
+        self.timestamp = array('d')
+        for key, location in locations:
+            self.set(key, location)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def set(self, key, location):
+        # an entity without a location keeps whatever it had
+        if not location:
+            return
+        accuracy = location.get('horizontalAccuracy')
+        stamp = location.get('timeStamp') or location.get('timestamp')
+        values = (location['latitude'], location['longitude'],
+                  nan if accuracy is None else accuracy, stamp or nan)
+        columns = (self.latitude, self.longitude, self.accuracy, self.timestamp)
+        row = self.index.get(key)
+        if row is None:
+            self.index[key] = len(self.latitude)
+            for column, value in zip(columns, values):
+                column.append(value)
+        else:
+            for column, value in zip(columns, values):
+                column[row] = value
+
+    def get(self, key):
+        row = self.index.get(key)
+        if row is None:
+            return None
+        accuracy = self.accuracy[row]
+        stamp = self.timestamp[row]
+        return {'latitude': self.latitude[row], 'longitude': self.longitude[row],
+                'horizontalAccuracy': None if isnan(accuracy) else accuracy,
+                'timeStamp': None if isnan(stamp) else stamp}
+
+    def fill_timestamps(self, stamps, now):
+        # a fix icloud sent without a time gets the time it was first seen,
+        # kept for as long as the same fix keeps coming back so it doesn't
+        # look new every cycle. stamps is id -> (lat, lng, timestamp),
+        # carried from one fetch to the next
+        for key, row in self.index.items():
+            if not isnan(self.timestamp[row]):
+                continue
+            lat = self.latitude[row]
+            lng = self.longitude[row]
+            seen = stamps.get(key)
+            if seen is None or seen[0] != lat or seen[1] != lng:
+                seen = stamps[key] = (lat, lng, now * 1000.0)
+            self.timestamp[row] = seen[2]
+
+    def version(self, key):
+        # tracking.position_version() of key's fix, None without one
+        row = self.index.get(key)
+        if row is None:
+            return None
+        stamp = self.timestamp[row]
+        return (None if isnan(stamp) else stamp, self.latitude[row], self.longitude[row])
+
+    def positions(self):
+        # id -> (lat, lng)
+        latitude = self.latitude
+        longitude = self.longitude
+        return {key: (latitude[row], longitude[row]) for key, row in self.index.items()}
+
+
+class LastKnownGood:
+    # the latest successful result of each fetch, to carry on with through
+    # an outage instead of every trackee going blank
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.results = {}
+        # when each fix without a timestamp was first seen, see
+        # PositionTable.fill_timestamps
+        self.stamps = {}
+
+    def resolve(self, name, result):
+        # (result, age): a fresh result is remembered and returned with age
+        # None, a failed one (None) is swapped for the last good one
+        now = self.clock()
+        if result is not None:
+            self.results[name] = (result, now)
+            return result, None
+        if name not in self.results:
+            return None, None
+        result, fetched = self.results[name]
+        return result, now - fetched
+
+
+def fetch_friend_locations(provider):
+    try:
+        with metrics.span('fetch_friends'):
+            # copied out right away, nothing holds on to the response
+            return PositionTable((friend['id'], friend.get('location'))
+                                 for friend in provider.friend_locations() or [])
+    except CircuitOpenError:
+        # already reported when the circuit opened
+        return None
+    except Exception as e:
+        print(f"failed to fetch friend locations: {e}")
+        metrics.count('fetch_errors')
+        return None
+
+def fetch_devices(provider):
+    # one request refreshes every device, after which each device's
+    # location is already in its content
+    try:
+        with metrics.span('fetch_devices'):
+            return list(provider.devices())
+    except CircuitOpenError:
+        return None
+    except Exception as e:
+        print(f"failed to fetch devices: {e}")
+        metrics.count('fetch_errors')
+        return None
@@ -0,0 +1,125 @@
+from math import floor, ceil, cos, radians
+
+from geodesic import haversine, METERS_PER_DEGREE
+
+
+class GridIndex:
+    # uniform lat/lng grid over the latest known position of each entity.
+    # moving an entity only touches the grid when it crosses into another
+    # cell, and a radius query only visits the cells the circle overlaps
+    def __init__(self, cell_size=1000.0):
+        # round the cell so a whole number of columns wraps the antimeridian
+        self.columns = int(ceil(360.0 / (cell_size / METERS_PER_DEGREE)))
+        self.cell_deg = 360.0 / self.columns
+        self.cells = {}
+        self.positions = {}
+        self.entity_cells = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def cell(self, lat, lng):
+        row = int(floor((lat + 90.0) / self.cell_deg))
+        col = int(floor(((lng + 180.0) % 360.0) / self.cell_deg)) % self.columns
+        return row, col
+
+    def update(self, key, lat, lng):
+        # returns True if the entity is new or changed cells
+        self.positions[key] = (lat, lng)
+        cell = self.cell(lat, lng)
+        old_cell = self.entity_cells.get(key)
+        if old_cell == cell:
+            return False
+        if old_cell is not None:
+            self._discard(old_cell, key)
+        self.cells.setdefault(cell, set()).add(key)
+        self.entity_cells[key] = cell
+        return True
+
+    def remove(self, key):
+        cell = self.entity_cells.pop(key, None)
+        if cell is not None:
+            self._discard(cell, key)
+        self.positions.pop(key, None)
+
+    def update_snapshot(self, positions):
+        # positions maps key -> (lat, lng) for one poll cycle. entities missing
+        # from the cycle keep their last known position. returns the keys
+        # that changed cells
+        return {key for key, (lat, lng) in positions.items() if self.update(key, lat, lng)}
+
+    def query_radius(self, lat, lng, radius):
+        # [(key, distance)] of every entity within radius meters of the point
+        found = []
+        for key in self._candidates(lat, lng, radius):
+            other_lat, other_lng = self.positions[key]
+            dist = haversine(lat, lng, other_lat, other_lng)
+            if dist <= radius:
+                found.append((key, dist))
+        return found
+
+    def _candidates(self, lat, lng, radius):
+        # pad the span slightly so rounding never drops a point on the edge
+        lat_span = radius / METERS_PER_DEGREE * 1.001
+        # longitude degrees shrink towards the poles, size the span for the
+        # widest latitude the circle reaches
+        widest = min(abs(lat) + lat_span, 89.9)
+        lng_span = lat_span / max(cos(radians(widest)), 1e-6)
+
+        min_row, min_col = self.cell(max(lat - lat_span, -90.0), lng - lng_span)
+        max_row, _ = self.cell(min(lat + lat_span, 90.0), lng)
+        col_count = min(int(ceil(2 * lng_span / self.cell_deg)) + 2, self.columns)
+
+        # a radius wider than the occupied grid, cheaper to scan what's there
+        if (max_row - min_row + 1) * col_count >= len(self.cells):
+            for members in self.cells.values():
+                yield from members
+            return
+
+        cols = [(min_col + i) % self.columns for i in range(col_count)]
+        for row in range(min_row, max_row + 1):
+            for col in cols:
+                yield from self.cells.get((row, col), ())
+
+    def _discard(self, cell, key):
+        members = self.cells[cell]
+        members.discard(key)
+        if not members:
+            del self.cells[cell]
+
+
+class ProximityWatcher:
+    # many-to-many proximity: tracks every pair of entities closer than
+    # distance meters, re-checking only entities that moved since last cycle
+    def __init__(self, distance, index=None):
+        self.distance = distance
+        self.index = index if index is not None else GridIndex(cell_size=max(distance, 100.0))
+        self.near = set()
+
+    def update(self, positions):
+        # positions maps key -> (lat, lng). returns (entered, left), the
+        # sets of pairs that came within range and went out of range
+        moved = {key for key, position in positions.items()
+                 if self.index.positions.get(key) != position}
+        self.index.update_snapshot({key: positions[key] for key in moved})
+
+        entered = set()
+        left = set()
+        for key in moved:
+            lat, lng = self.index.positions[key]
+            in_range = {frozenset((key, other))
+                        for other, _ in self.index.query_radius(lat, lng, self.distance)
+                        if other != key}
+            was_in_range = {pair for pair in self.near if key in pair}
+            entered |= in_range - was_in_range
+            left |= was_in_range - in_range
+            self.near -= was_in_range - in_range
+            self.near |= in_range
+        return entered, left
+
+    def remove(self, key):
+        self.index.remove(key)
+        self.near = {pair for pair in self.near if key not in pair}
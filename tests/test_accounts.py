@@ -0,0 +1,93 @@
+from notifications import NotificationDispatcher
+from providers import AccountsProvider, LocationProvider
+from snapshot import LocationSnapshot
+from tracking import TrackingConfig, handle
+
+
+class Account(LocationProvider):
+    def __init__(self, devices):
+        self.device_list = devices
+        self.down = False
+
+    def devices(self):
+        if self.down:
+            raise ConnectionError("down")
+        return list(self.device_list)
+
+    def friends(self):
+        return []
+
+    def friend_locations(self):
+        return []
+
+
+def device(id, lat, lng=-122.0):
+    return {'id': id, 'name': id, 'deviceDisplayName': 'iPhone',
+            'location': {'latitude': lat, 'longitude': lng, 'horizontalAccuracy': 10.0,
+                         'timeStamp': 1600000000000}}
+
+
+def test_shared_devices_show_up_once():
+    shared = device('ipad', 37.0)
+    accounts = AccountsProvider({'me': Account([device('mine', 37.0), shared]),
+                                 'mom': Account([shared, device('moms', 38.0)])})
+    try:
+        assert [d['id'] for d in accounts.devices()] == ['mine', 'ipad', 'moms']
+    finally:
+        accounts.close()
+
+
+def test_rules_follow_the_device_when_an_account_changes():
+    me = Account([device('mine', 37.0)])
+    mom = Account([device('moms', 37.0), device('dads', 40.0)])
+    accounts = AccountsProvider({'me': me, 'mom': mom}, budget=100)
+    notifier = NotificationDispatcher()
+    try:
+        devices = accounts.devices()
+        trackee = TrackingConfig("device", devices[0], 'mine')
+        trackee.watch_proximity = True
+        trackee.proximity_to = 'dads'
+        trackee.distance = 1000.0
+
+        # a new device ahead of dad's in the merged list
+        me.device_list = [device('mine', 37.0), device('new', 37.0)]
+        snapshot = LocationSnapshot(devices=accounts.devices())
+        assert snapshot.device(trackee.proximity_to)['id'] == 'dads'
+        handle(trackee, snapshot, notifier)
+        assert not any(entry.event and 'is near' in entry.event for entry in trackee.log_entries)
+
+        # dad comes over
+        mom.device_list = [device('moms', 37.0), device('dads', 37.0)]
+        handle(trackee, LocationSnapshot(devices=accounts.devices()), notifier)
+        assert any(entry.event == "dads is near mine" for entry in trackee.log_entries)
+    finally:
+        accounts.close()
+
+
+def test_a_failed_accounts_devices_are_stale():
+    now = [0.0]
+    me = Account([device('mine', 37.0)])
+    mom = Account([device('dads', 37.0)])
+    accounts = AccountsProvider({'me': me, 'mom': mom}, budget=100, clock=lambda: now[0])
+    notifier = NotificationDispatcher()
+    try:
+        snapshot = LocationSnapshot.fetch(accounts, need_friends=False)
+        assert snapshot.device_age('dads') is None
+
+        trackee = TrackingConfig("device", snapshot.device('mine'), 'mine')
+        trackee.watch_proximity = True
+        trackee.proximity_to = 'dads'
+        trackee.distance = 1000.0
+
+        # dad's account goes down, his old position is still served
+        # but is no reason to say he's near
+        mom.down = True
+        now[0] = 600.0
+        snapshot = LocationSnapshot.fetch(accounts, need_friends=False)
+        assert snapshot.device_location('dads') is not None
+        assert snapshot.device_age('dads') == 600.0
+        assert snapshot.device_age('mine') is None
+        handle(trackee, snapshot, notifier)
+        assert not any(entry.event and 'is near' in entry.event for entry in trackee.log_entries)
+    finally:
+        accounts.close()
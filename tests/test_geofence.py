@@ -0,0 +1,69 @@
+from geofence import Zone, Geofence, ZoneSet, ENTER, EXIT, DWELL
+
+HOME = (37.4285, -122.1527)
+# degrees of latitude per meter, near enough
+DEGREE = 1 / 111195.0
+START = 1600000000
+
+
+def fix(north, seconds):
+    # a fix north meters north of HOME, seconds after START
+    return {'latitude': HOME[0] + north * DEGREE, 'longitude': HOME[1],
+            'horizontalAccuracy': 10.0, 'timeStamp': (START + seconds) * 1000.0}
+
+
+def test_first_fix_only_sets_the_state():
+    fence = Geofence([Zone('home', HOME, 200.0)])
+    assert fence.update(fix(0.0, 0)) == []
+    assert fence.inside == {0}
+
+
+def test_entering_and_leaving():
+    home = Zone('home', HOME, 200.0)
+    square = Zone('square', polygon=[(HOME[0] + 900 * DEGREE, HOME[1] - 0.002),
+                                     (HOME[0] + 900 * DEGREE, HOME[1] + 0.002),
+                                     (HOME[0] + 1100 * DEGREE, HOME[1] + 0.002),
+                                     (HOME[0] + 1100 * DEGREE, HOME[1] - 0.002)])
+    fence = Geofence([home, square])
+    fence.update(fix(0.0, 0))
+    assert fence.update(fix(500.0, 60)) == [(EXIT, home)]
+    assert fence.update(fix(1000.0, 120)) == [(ENTER, square)]
+    assert fence.update(fix(1000.0, 180)) == []
+    assert fence.update(fix(0.0, 240)) == [(ENTER, home), (EXIT, square)]
+
+
+def test_dwell_goes_off_once_after_staying():
+    home = Zone('home', HOME, 200.0, dwell=600)
+    fence = Geofence([home])
+    fence.update(fix(500.0, 0))
+    assert fence.update(fix(0.0, 100)) == [(ENTER, home)]
+    assert fence.update(fix(10.0, 600)) == []
+    assert fence.update(fix(0.0, 700)) == [(DWELL, home)]
+    assert fence.update(fix(10.0, 2000)) == []
+    # leaving before the dwell is up cancels it
+    fence.update(fix(500.0, 2100))
+    fence.update(fix(0.0, 2200))
+    assert fence.update(fix(500.0, 2300)) == [(EXIT, home)]
+    assert fence.update(fix(500.0, 4000)) == []
+
+
+def test_fixes_within_the_margin_skip_the_evaluation():
+    zones = ZoneSet([Zone('home', HOME, 200.0, dwell=600)])
+    evaluations = []
+    evaluate = zones.evaluate
+    zones.evaluate = lambda lat, lng: evaluations.append((lat, lng)) or evaluate(lat, lng)
+    fence = Geofence(zones)
+
+    fence.update(fix(0.0, 0))
+    assert len(evaluations) == 1
+    assert abs(fence.margin - 200.0) < 1.0
+    # 50 m closer to the edge, nothing could have been crossed
+    assert fence.update(fix(50.0, 60)) == []
+    assert len(evaluations) == 1
+    assert abs(fence.margin - 150.0) < 1.0
+    # but dwell still goes by the fix's time
+    assert fence.update(fix(50.0, 600)) == [(DWELL, zones.zones[0])]
+    assert len(evaluations) == 1
+    # past the margin it's evaluated again
+    assert fence.update(fix(250.0, 660)) == [(EXIT, zones.zones[0])]
+    assert len(evaluations) == 2
@@ -0,0 +1,39 @@
+import builtins
+import io
+
+from metrics import Metrics, StartupProfile
+
+
+def test_startup_profile_times_imports_until_stopped():
+    original = builtins.__import__
+    profile = StartupProfile().watch_imports()
+    try:
+        assert builtins.__import__ == profile.timed_import
+        import json
+        profile.mark('step')
+    finally:
+        profile.stop()
+    assert builtins.__import__ is original
+    out = io.StringIO()
+    profile.report('window', out)
+    assert 'step' in out.getvalue()
+
+
+def test_stop_leaves_a_later_hook_alone():
+    original = builtins.__import__
+    profile = StartupProfile().watch_imports()
+    other = lambda *args, **kwargs: original(*args, **kwargs)
+    builtins.__import__ = other
+    try:
+        profile.stop()
+        assert builtins.__import__ is other
+    finally:
+        builtins.__import__ = original
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+    with metrics.span('cycle'):
+        pass
+    metrics.count('alerts')
+    assert metrics.snapshot()['histograms'] == {} and metrics.snapshot()['counters'] == {}
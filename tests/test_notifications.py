@@ -0,0 +1,38 @@
+import notifications
+from notifications import NotificationDispatcher, Sink, default_dispatcher
+
+
+class Collect(Sink):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, notification):
+        self.sent.append(notification.message)
+
+
+def test_macos_channels_only_where_their_commands_exist(monkeypatch):
+    monkeypatch.setattr(notifications.sys, 'platform', 'linux')
+    dispatcher = default_dispatcher()
+    try:
+        assert set(dispatcher.channels) == {'device'}
+        assert not dispatcher.post('desktop', 'Zone Left', "Mom left home")
+    finally:
+        dispatcher.close(1)
+
+    monkeypatch.setattr(notifications.sys, 'platform', 'darwin')
+    monkeypatch.setattr(notifications.shutil, 'which', lambda command: f'/usr/bin/{command}')
+    dispatcher = default_dispatcher()
+    try:
+        assert set(dispatcher.channels) == {'desktop', 'speech', 'device'}
+    finally:
+        dispatcher.close(1)
+
+
+def test_repeats_are_coalesced():
+    sink = Collect()
+    dispatcher = NotificationDispatcher()
+    dispatcher.register('log', sink)
+    assert dispatcher.post('log', 'Zone Left', "Mom left home")
+    assert not dispatcher.post('log', 'Zone Left', "Mom left home")
+    dispatcher.close(1)
+    assert sink.sent == ["Mom left home"]
@@ -0,0 +1,73 @@
+import json
+import socket
+import urllib.request
+from types import SimpleNamespace
+
+import push_server
+from push_server import PushServer, Subscriber
+
+
+class Track:
+    def __init__(self, location):
+        self.fix = location
+
+    def location(self):
+        return self.fix
+
+
+def trackee(id, lat, lng):
+    location = {'latitude': lat, 'longitude': lng, 'horizontalAccuracy': 10.0, 'timeStamp': 1600000000000}
+    return SimpleNamespace(id=id, display_name=id.title(), speed=None, track=Track(location))
+
+
+def test_start_stop_without_clients():
+    server = PushServer(0).start()
+    server.stop()
+    assert not server.thread.is_alive()
+    assert server.loop.is_closed()
+
+
+def test_state_and_stop_with_open_stream():
+    server = PushServer(0).start()
+    try:
+        server.publish([trackee('mom', 37.0, -122.0)])
+        stream = socket.create_connection(('127.0.0.1', server.port))
+        stream.sendall(b'GET /events HTTP/1.1\r\n\r\n')
+        received = b''
+        while b'event: position' not in received:
+            received += stream.recv(4096)
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.port}/state') as response:
+            states = json.loads(response.read())
+        assert [state['id'] for state in states] == ['mom']
+    finally:
+        server.stop()
+    assert server.loop.is_closed()
+    stream.close()
+
+
+class SlowWriter:
+    def __init__(self):
+        self.transport = SimpleNamespace(abort=self.abort)
+        self.aborts = 0
+
+    def abort(self):
+        self.aborts += 1
+
+
+def test_slow_subscriber_is_dropped_once(capsys):
+    writer = SlowWriter()
+    subscriber = Subscriber(writer)
+    for i in range(push_server.MAX_PENDING * 2):
+        subscriber.push(None, b'event: alert\n\n')
+    assert subscriber.closed
+    assert writer.aborts == 1
+    assert not subscriber.pending
+    assert capsys.readouterr().out.count("too slow") == 1
+
+
+def test_positions_conflate_while_waiting():
+    subscriber = Subscriber(SlowWriter())
+    for i in range(push_server.MAX_PENDING * 2):
+        subscriber.push('mom', f'event: position\ndata: {i}\n\n'.encode())
+    assert not subscriber.closed
+    assert list(subscriber.pending) == ['mom']
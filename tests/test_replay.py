@@ -0,0 +1,66 @@
+import configparser
+import os
+
+import pytest
+
+from headless import build_trackees
+from history import LocationHistory
+from replay import TraceProvider, read_binary, read_history, replay, trace_keys, write_binary
+
+CONFIG = """
+[trackee:mom]
+name = Mom
+id = icloud-mom
+watch_proximity = yes
+proximity_to = Home Phone
+distance = 100
+"""
+
+
+def trackees_for(text):
+    parser = configparser.ConfigParser()
+    parser.read_string(text)
+    provider = TraceProvider(trace_keys(parser))
+    return list(build_trackees(parser, provider).values()), provider.devices()
+
+
+def test_history_ids_match_trackees_by_id():
+    trackees, devices = trackees_for(CONFIG)
+    fixes = [('Home Phone', 1600000000, 37.0, -122.0, 10.0),
+             ('icloud-mom', 1600000010, 37.0, -122.0, 10.0),
+             ('icloud-dad', 1600000020, 38.0, -122.0, 10.0)]
+    alerts = []
+    read, handled, unmatched = replay(fixes, trackees, devices, lambda *alert: alerts.append(alert))
+    assert (read, handled) == (3, 1)
+    assert dict(unmatched) == {'icloud-dad': 1}
+    assert [title for _, title, _ in alerts] == ['Proximity Detected']
+
+
+def test_write_binary_round_trips(tmp_path):
+    path = str(tmp_path / 'trace.fix')
+    fixes = [('a', 1.0, 37.0, -122.0, None), ('b', 2.0, 38.0, -121.0, 5.0)]
+    assert write_binary(iter(fixes), path) == 2
+    assert list(read_binary(path)) == fixes
+    assert os.listdir(tmp_path) == ['trace.fix']
+
+
+def test_write_binary_cleans_up_after_a_failed_read(tmp_path):
+    def broken():
+        yield ('a', 1.0, 37.0, -122.0, None)
+        raise ValueError("bad trace")
+
+    with pytest.raises(ValueError):
+        write_binary(broken(), str(tmp_path / 'trace.fix'))
+    assert os.listdir(tmp_path) == []
+
+
+def test_history_is_read_in_time_order(tmp_path):
+    path = str(tmp_path / 'history.db')
+    history = LocationHistory(path)
+    history.append([('b', {'latitude': 2.0, 'longitude': 0.0, 'timeStamp': 1600000001000}),
+                    ('a', {'latitude': 1.0, 'longitude': 0.0, 'timeStamp': 1600000002000})])
+    history.append([('c', {'latitude': 3.0, 'longitude': 0.0, 'timeStamp': 1600000000000}),
+                    ('a', {'latitude': 1.5, 'longitude': 0.0, 'timeStamp': 1600000003000})])
+    history.close()
+    assert [(fix[0], fix[1]) for fix in read_history(path)] == [
+        ('c', 1600000000.0), ('b', 1600000001.0), ('a', 1600000002.0), ('a', 1600000003.0)]
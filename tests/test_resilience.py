@@ -0,0 +1,124 @@
+import pytest
+
+from providers import LocationProvider
+from resilience import CircuitBreaker, CircuitOpenError, ResilientProvider
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Flaky(LocationProvider):
+    # fails the first `failures` calls to devices(), by raising or by
+    # returning None
+    def __init__(self, failures, result=None, raises=True):
+        self.failures = failures
+        self.result = result
+        self.raises = raises
+        self.calls = 0
+
+    def devices(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            if self.raises:
+                raise ConnectionError("down")
+            return None
+        return self.result
+
+
+def test_breaker_opens_after_threshold_failures():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=3, cooldown=30.0, clock=clock)
+    assert not breaker.failure()
+    assert not breaker.failure()
+    assert breaker.allow()
+    assert breaker.failure()
+    assert breaker.open
+    assert not breaker.allow()
+    clock.now = 10.0
+    assert breaker.retry_in() == 20.0
+
+
+def test_breaker_lets_one_trial_through_after_the_cooldown():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=1, cooldown=30.0, clock=clock)
+    breaker.failure()
+    clock.now = 30.0
+    assert breaker.allow()
+    # only the one
+    assert not breaker.allow()
+    breaker.success()
+    assert not breaker.open
+    assert breaker.allow()
+
+
+def test_a_failed_trial_doubles_the_cooldown():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=1, cooldown=30.0, max_cooldown=100.0, clock=clock)
+    breaker.failure()
+    for cooldown in (60.0, 100.0, 100.0):
+        clock.now += breaker.cooldown
+        assert breaker.allow()
+        assert not breaker.failure()
+        assert breaker.cooldown == cooldown
+        assert breaker.retry_in() == cooldown
+    # and a good trial resets it
+    clock.now += breaker.cooldown
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.cooldown == 30.0
+
+
+def test_calls_are_retried_with_backoff():
+    sleeps = []
+    flaky = Flaky(2, result=['ok'])
+    provider = ResilientProvider(flaky, attempts=3, backoff_base=1.0, backoff_cap=3.0,
+                                 clock=Clock(), sleep=sleeps.append, seed=1)
+    assert provider.devices() == ['ok']
+    assert flaky.calls == 3
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= 2.0 and 0 <= sleeps[1] <= 3.0
+    assert provider.breakers['devices'].failures == 0
+
+
+def test_giving_up_raises_the_last_error():
+    flaky = Flaky(10)
+    provider = ResilientProvider(flaky, attempts=3, threshold=2, clock=Clock(), sleep=lambda s: None)
+    with pytest.raises(ConnectionError):
+        provider.devices()
+    assert flaky.calls == 3
+    assert provider.breakers['devices'].failures == 1
+
+
+def test_nothing_returned_counts_as_a_failure():
+    flaky = Flaky(10, raises=False)
+    provider = ResilientProvider(flaky, attempts=2, threshold=1, clock=Clock(), sleep=lambda s: None)
+    with pytest.raises(ValueError):
+        provider.devices()
+    assert flaky.calls == 2
+    assert provider.breakers['devices'].open
+
+
+def test_an_open_circuit_fails_at_once_then_tries_once():
+    clock = Clock()
+    flaky = Flaky(10)
+    provider = ResilientProvider(flaky, attempts=3, threshold=1, cooldown=30.0,
+                                 clock=clock, sleep=lambda s: None)
+    with pytest.raises(ConnectionError):
+        provider.devices()
+    assert flaky.calls == 3
+    with pytest.raises(CircuitOpenError):
+        provider.devices()
+    assert flaky.calls == 3
+    assert provider.retry_in() == 30.0
+
+    clock.now = 30.0
+    with pytest.raises(ConnectionError):
+        provider.devices()
+    # a half open trial is a single attempt
+    assert flaky.calls == 4
+    assert provider.retry_in() == 60.0
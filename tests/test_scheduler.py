@@ -0,0 +1,44 @@
+from scheduler import (PollScheduler, next_interval, DEFAULT_INTERVAL, MAX_INTERVAL, MIN_INTERVAL,
+                       STATIONARY_SPEED)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_stationary_far_from_any_threshold_backs_off():
+    assert next_interval(120, 0.0, None) == 240
+    assert next_interval(600, 0.0, 5000.0) == MAX_INTERVAL
+
+
+def test_stationary_near_a_threshold_keeps_polling():
+    # parked 20 m inside a proximity distance
+    assert next_interval(600, 0.0, 20.0) == MIN_INTERVAL
+    assert next_interval(120, 0.1, 200.0) == 200.0 / STATIONARY_SPEED / 2
+
+
+def test_unknown_speed_near_a_threshold():
+    assert next_interval(120, None, None) == DEFAULT_INTERVAL
+    assert next_interval(120, None, 20.0) == MIN_INTERVAL
+
+
+def test_moving_polls_twice_before_the_threshold():
+    assert next_interval(120, 10.0, 3000.0) == 150.0
+    assert next_interval(120, 30.0, 10.0) == MIN_INTERVAL
+    assert next_interval(120, 10.0, None) == 60
+
+
+def test_pop_due_coalesces_and_skips_removed():
+    clock = Clock()
+    scheduler = PollScheduler(clock=clock)
+    scheduler.schedule('a', 10)
+    scheduler.schedule('b', 20)
+    scheduler.schedule('c', 100)
+    scheduler.remove('b')
+    clock.now = 10
+    assert scheduler.pop_due(window=15) == ['a']
+    assert scheduler.next_due() == 90
@@ -0,0 +1,60 @@
+from geodesic import haversine
+from smoothing import TrackFilter, MAX_REJECTS
+
+LAT, LNG = 37.4285, -122.1527
+# degrees of latitude per meter, near enough
+DEGREE = 1 / 111195.0
+
+
+def fix(north, timestamp, accuracy=10.0):
+    # a fix north meters north of LAT, LNG
+    return {'latitude': LAT + north * DEGREE, 'longitude': LNG,
+            'horizontalAccuracy': accuracy, 'timeStamp': timestamp * 1000.0}
+
+
+def parked(fixes=5, interval=120):
+    track = TrackFilter()
+    for i in range(fixes):
+        # a few meters of gps jitter
+        track.update(fix((-1) ** i * 3.0, 1600000000 + i * interval))
+    return track, 1600000000 + (fixes - 1) * interval
+
+
+def test_jitter_doesnt_read_as_moving():
+    track, _ = parked()
+    assert track.speed < 0.5
+    assert haversine(LAT, LNG, track.lat, track.lng) < 5.0
+
+
+def test_the_same_fix_twice_is_dropped():
+    track, last = parked()
+    assert not track.update(fix(3.0, last))
+
+
+def test_a_precise_departure_is_taken_at_once():
+    track, last = parked()
+    # 1.8 km two minutes later, 15 m/s
+    assert track.update(fix(1800.0, last + 120, accuracy=65.0))
+    assert track.rejects == 0
+    assert abs(track.speed - 15.0) < 0.5
+    assert haversine(LAT + 1800.0 * DEGREE, LNG, track.lat, track.lng) < 1.0
+    # and keeps going from there
+    assert track.update(fix(3600.0, last + 240, accuracy=65.0))
+    assert haversine(LAT + 3600.0 * DEGREE, LNG, track.lat, track.lng) < 100.0
+
+
+def test_a_coarse_jump_is_dropped_until_it_repeats():
+    track, last = parked()
+    lat, lng = track.lat, track.lng
+    assert not track.update(fix(5000.0, last + 120, accuracy=300.0))
+    assert track.rejects == 1
+    assert (track.lat, track.lng) == (lat, lng)
+    # back where it was, the jump was a glitch
+    assert track.update(fix(3.0, last + 240))
+    assert track.rejects == 0
+
+    for i in range(MAX_REJECTS - 1):
+        assert not track.update(fix(5000.0, last + 360 + 120 * i, accuracy=300.0))
+    # it kept reporting from over there
+    assert track.update(fix(5000.0, last + 360 + 120 * (MAX_REJECTS - 1), accuracy=300.0))
+    assert haversine(LAT + 5000.0 * DEGREE, LNG, track.lat, track.lng) < 1.0
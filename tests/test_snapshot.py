@@ -0,0 +1,71 @@
+from providers import LocationProvider
+from snapshot import LastKnownGood, LocationSnapshot, PositionTable
+from tracking import position_version
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1600000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Friends(LocationProvider):
+    def __init__(self):
+        self.location = {'latitude': 37.0, 'longitude': -122.0, 'horizontalAccuracy': 10.0}
+
+    def friend_locations(self):
+        return [{'id': 'mom', 'location': dict(self.location)}]
+
+
+def test_fix_without_timestamp_keeps_its_first_seen_time():
+    clock = Clock()
+    provider = Friends()
+    last_known = LastKnownGood(clock)
+
+    first = LocationSnapshot.fetch(provider, need_devices=False, last_known=last_known)
+    clock.now += 120
+    again = LocationSnapshot.fetch(provider, need_devices=False, last_known=last_known)
+    first_fix = first.friend_locations.get('mom')
+    again_fix = again.friend_locations.get('mom')
+    assert first_fix['timeStamp'] == 1600000000000.0
+    assert position_version(again_fix) == position_version(first_fix)
+
+    provider.location['latitude'] = 37.01
+    moved = LocationSnapshot.fetch(provider, need_devices=False, last_known=last_known)
+    assert moved.friend_locations.get('mom')['timeStamp'] == 1600000120000.0
+
+
+def test_missing_timestamp_is_not_made_up():
+    table = PositionTable([('mom', {'latitude': 37.0, 'longitude': -122.0})])
+    assert table.get('mom')['timeStamp'] is None
+    assert table.get('mom')['horizontalAccuracy'] is None
+
+
+def test_devices_are_looked_up_by_id():
+    device = {'id': 'ipad', 'name': 'iPad',
+              'location': {'latitude': 37.0, 'longitude': -122.0, 'timeStamp': 1600000000000}}
+    snapshot = LocationSnapshot(devices=[device])
+    assert snapshot.device('ipad') is device
+    assert snapshot.device_location('ipad')['latitude'] == 37.0
+    assert snapshot.device('gone') is None and snapshot.device_location('gone') is None
+
+
+class AppleDevice:
+    # like pyicloud's, item access goes straight to the content dict
+    def __init__(self, content):
+        self._content = content
+
+    def __getitem__(self, key):
+        return self._content[key]
+
+
+def test_devices_without_a_location_are_skipped():
+    located = AppleDevice({'id': 'ipad', 'name': 'iPad',
+                           'location': {'latitude': 37.0, 'longitude': -122.0, 'timeStamp': 1600000000000}})
+    unlocated = AppleDevice({'id': 'watch', 'name': 'Watch'})
+    snapshot = LocationSnapshot(devices=[unlocated, located])
+    assert snapshot.device('watch') is unlocated
+    assert snapshot.device_location('watch') is None
+    assert snapshot.device_location('ipad')['latitude'] == 37.0
@@ -0,0 +1,17 @@
+from spatial_index import GridIndex, ProximityWatcher
+
+
+def test_watcher_uses_an_empty_index_it_is_given():
+    index = GridIndex(cell_size=500.0)
+    watcher = ProximityWatcher(200.0, index)
+    assert watcher.index is index
+    watcher.update({'a': (37.0, -122.0), 'b': (37.001, -122.0)})
+    assert len(index) == 2
+
+
+def test_watcher_reports_pairs_entering_and_leaving():
+    watcher = ProximityWatcher(200.0)
+    entered, left = watcher.update({'a': (37.0, -122.0), 'b': (37.001, -122.0), 'c': (38.0, -122.0)})
+    assert entered == {frozenset(('a', 'b'))} and not left
+    entered, left = watcher.update({'a': (37.0, -122.0), 'b': (37.01, -122.0), 'c': (38.0, -122.0)})
+    assert not entered and left == {frozenset(('a', 'b'))}
@@ -0,0 +1,127 @@
+from datetime import datetime
+
+import tracking
+from notifications import NotificationDispatcher
+from snapshot import LocationSnapshot
+from tracking import RuleGraph, TrackingConfig, TrackLog, handle
+
+
+def fill(log, n):
+    for i in range(n):
+        log.append(1600000000 + i, 37.0, -122.0, float(i), f"event {i % 3}")
+
+
+def test_tail_is_the_end_of_the_log():
+    log = TrackLog(5)
+    fill(log, 12)
+    entries = list(log)
+    assert [entry.delta for entry in entries] == [7.0, 8.0, 9.0, 10.0, 11.0]
+    assert list(log.tail(2)) == entries[-2:]
+    assert list(log.tail(50)) == entries
+    assert list(log.tail(0)) == []
+
+
+def test_tail_only_decodes_what_it_returns(monkeypatch):
+    log = TrackLog(1000)
+    fill(log, 1000)
+    decoded = []
+
+    class Clock:
+        @staticmethod
+        def fromtimestamp(timestamp):
+            decoded.append(timestamp)
+            return datetime.fromtimestamp(timestamp)
+
+    monkeypatch.setattr(tracking, 'datetime', Clock)
+    assert [entry.delta for entry in log.tail(3)] == [997.0, 998.0, 999.0]
+    assert len(decoded) == 3
+
+
+def near_home(devices_age):
+    location = {'latitude': 37.0, 'longitude': -122.0, 'horizontalAccuracy': 10.0, 'timestamp': 1600000000000}
+    home = {'id': 'home', 'name': 'Home iPad',
+            'location': {'latitude': 37.0, 'longitude': -122.0, 'timeStamp': 1600000000000}}
+    return LocationSnapshot({'mom': location}, [home], devices_age=devices_age)
+
+
+def test_proximity_skips_a_target_only_known_from_before_an_outage():
+    trackee = TrackingConfig("friend", {'id': 'mom'}, 'Mom')
+    trackee.watch_proximity = True
+    trackee.proximity_to = 'home'
+    notifier = NotificationDispatcher()
+
+    handle(trackee, near_home(devices_age=600), notifier)
+    events = [entry.event for entry in trackee.log_entries if entry.event]
+    assert events == ["iCloud unavailable, not checking proximity to a location 10 min old"]
+
+    handle(trackee, near_home(devices_age=None), notifier)
+    assert list(trackee.log_entries)[-1].event == "Home iPad is near Mom"
+
+
+def fix(lat, stamp):
+    return {'latitude': lat, 'longitude': -122.0, 'horizontalAccuracy': 10.0, 'timeStamp': stamp * 1000}
+
+
+def device_snapshot(fixes):
+    return LocationSnapshot(devices=[{'id': key, 'name': key, 'location': location}
+                                     for key, location in fixes.items()])
+
+
+def watched_trackees():
+    graph = RuleGraph()
+    trackees = []
+    for key in ('a', 'b', 'c'):
+        trackee = TrackingConfig("device", {'id': key}, key)
+        trackee.watch_proximity = True
+        trackee.proximity_to = 'home'
+        trackee.distance = 100.0
+        graph.watch(trackee)
+        trackees.append(trackee)
+    return graph, trackees
+
+
+def test_only_trackees_whose_inputs_changed_are_handled():
+    graph, (a, b, c) = watched_trackees()
+    notifier = NotificationDispatcher()
+    fixes = {'home': fix(37.0, 1), 'a': fix(37.1, 1), 'b': fix(37.2, 1), 'c': fix(37.3, 1)}
+    assert graph.evaluate([a, b, c], device_snapshot(fixes), notifier) == [a, b, c]
+    assert graph.evaluate([a, b, c], device_snapshot(fixes), notifier) == []
+
+    fixes['a'] = fix(37.11, 2)
+    assert graph.evaluate([a, b, c], device_snapshot(fixes), notifier) == [a]
+
+    # everyone reads home
+    fixes['home'] = fix(37.01, 2)
+    assert graph.evaluate([a, b, c], device_snapshot(fixes), notifier) == [a, b, c]
+
+
+def test_changes_wait_for_trackees_that_are_not_due():
+    graph, (a, b, c) = watched_trackees()
+    notifier = NotificationDispatcher()
+    fixes = {'home': fix(37.0, 1), 'a': fix(37.1, 1), 'b': fix(37.2, 1), 'c': fix(37.3, 1)}
+    graph.evaluate([a, b, c], device_snapshot(fixes), notifier)
+
+    fixes['b'] = fix(37.21, 2)
+    assert graph.evaluate([a], device_snapshot(fixes), notifier) == []
+    assert graph.evaluate([b], device_snapshot(fixes), notifier) == [b]
+
+
+def test_edited_rules_and_missing_fixes_are_handled():
+    graph, (a, b, c) = watched_trackees()
+    notifier = NotificationDispatcher()
+    fixes = {'home': fix(37.0, 1), 'a': fix(37.1, 1), 'b': fix(37.2, 1), 'c': fix(37.3, 1)}
+    graph.evaluate([a, b, c], device_snapshot(fixes), notifier)
+
+    b['distance'] = 50000.0
+    assert graph.evaluate([a, b, c], device_snapshot(fixes), notifier) == [b]
+    assert list(b.log_entries)[-1].event == "home is near b"
+
+    # a now reads c instead of home
+    a['proximity_to'] = 'c'
+    graph.evaluate([a], device_snapshot(fixes), notifier)
+    fixes['home'] = fix(37.01, 2)
+    assert graph.evaluate([a, b, c], device_snapshot(fixes), notifier) == [b, c]
+
+    del fixes['c']
+    assert graph.evaluate([c], device_snapshot(fixes), notifier) == [c]
+    assert list(c.log_entries)[-1].event == "Error retrieving location"
@@ -0,0 +1,370 @@
+import struct
+import time
+from datetime import datetime
+from math import hypot, isnan, nan
+from collections import namedtuple
+
+from geodesic import haversine
+from metrics import metrics
+from scheduler import DEFAULT_INTERVAL
+from smoothing import TrackFilter
+
+# log entries kept per trackee, older ones are dropped
+LOG_CAPACITY = 1000
+# one log entry: unix seconds, latitude and longitude in 1e-7 degrees, the
+# delta in meters (nan when there's none) and the message number, 0 for none
+LOG_RECORD = struct.Struct('<IiifI')
+COORDINATE_SCALE = 1e7
+# latitude and longitude of an entry logged without a location
+NO_COORDINATE = -2**31
+# the settings a user picks for a trackee, what gets saved between runs
+RULE_FIELDS = [
+    'watch_movement', 'tolerance', 'watch_movement_audio', 'watch_movement_device_cb',
+    'watch_movement_device_adb', 'watch_proximity', 'proximity_to', 'distance',
+    'watch_proximity_audio', 'watch_proximity_device_cb', 'watch_proximity_device_adb',
+]
+# rule fields holding the id of a device, not its place in the device list,
+# which shifts whenever an account gains, loses or reorders a device
+DEVICE_FIELDS = ['watch_movement_device_adb', 'proximity_to', 'watch_proximity_device_adb']
+# how many sigmas of combined uncertainty a move has to stand out by
+MOVE_CONFIDENCE = 3.0
+
+
+def find_distance(location1, location2):
+    return haversine(location1['latitude'], location1['longitude'],
+                     location2['latitude'], location2['longitude'])
+
+def position_version(location):
+    # tells fixes apart, icloud hands back the same one until the device
+    # reports again
+    return (location.get('timeStamp') or location.get('timestamp'),
+            location['latitude'], location['longitude'])
+
+@metrics.timed('handle')
+def handle(config, snapshot, notifier):
+    location = snapshot.location(config)
+
+    # couldn't retrieve location
+    if not location:
+        if (config.watch_movement and config.watch_movement_audio) or \
+            (config.watch_proximity and config.watch_proximity_audio) or \
+            (config.geofence is not None and config.watch_zones_audio):
+            notifier.post('speech', None, "Error retrieving location")
+        config.log(f"Error retrieving location")
+        return
+
+    # icloud is down and this is the last fix that came through. nothing
+    # new to judge the rules on, and one outage shouldn't alert every trackee
+    age = snapshot.age(config)
+    if age is not None:
+        config.log(f"iCloud unavailable, last known location is {age / 60:.0f} min old", location=location)
+        return
+
+    # movement and speed go off the smoothed track, not the raw fix, so
+    # gps jitter and wifi jumps don't read as the trackee moving. the track
+    # and the zones only take a new fix, handle() also runs when just the
+    # proximity target moved or a rule was edited
+    version = position_version(location)
+    moved = version != config.fix_version
+    if moved:
+        config.fix_version = version
+        config.track.update(location)
+        config.speed = config.track.speed
+        config.estimate = config.track.location()
+    estimate = config.estimate
+    # meters away from flipping the nearest rule
+    margins = []
+
+    # movement logic
+    dist = None
+    if config.watch_movement and config.last_location is not None:
+        dist = find_distance(config.last_location, estimate)
+        margins.append(abs(config.tolerance - dist))
+    config.log(location=location, delta=dist)
+
+    if dist is not None:
+        # while tracking movement, only update lastlocation 
+        # after a detection to prevent creeping
+        if dist >= config.tolerance and dist >= MOVE_CONFIDENCE * hypot(
+                config.last_location['horizontalAccuracy'], estimate['horizontalAccuracy']):
+            msg = f"{config.display_name} has moved." 
+            alert(notifier, 'Movement Detected', msg, config.watch_movement_audio,
+                  snapshot.device(config.watch_movement_device_adb) if config.watch_movement_device_cb else None)
+            config.log(msg)
+            config.last_location = estimate
+    else:
+        config.last_location = estimate
+
+    # geofence logic, nothing can be crossed or dwelled in without a new fix
+    if config.geofence is not None:
+        # only imported once there are zones, it brings in numpy
+        from geofence import ENTER, EXIT
+        for event, zone in config.geofence.update(estimate) if moved else ():
+            if event == ENTER:
+                title, msg = 'Zone Entered', f"{config.display_name} arrived at {zone.name}"
+            elif event == EXIT:
+                title, msg = 'Zone Left', f"{config.display_name} left {zone.name}"
+            else:
+                title, msg = 'Zone Dwell', f"{config.display_name} has been at {zone.name} for {zone.dwell / 60:.0f} minutes"
+            alert(notifier, title, msg, config.watch_zones_audio,
+                  snapshot.device(config.watch_zones_device_adb) if config.watch_zones_device_cb else None)
+            config.log(msg)
+        if config.geofence.margin is not None:
+            margins.append(config.geofence.margin)
+
+    # proximity logic, a target only known from before an outage isn't
+    # where it was, so it's left alone until it's fetched again
+    proximity_location = snapshot.device_location(config.proximity_to) if config.watch_proximity else None
+    target_age = snapshot.device_age(config.proximity_to) if proximity_location else None
+    if target_age is not None:
+        config.log(f"iCloud unavailable, not checking proximity to a location {target_age / 60:.0f} min old")
+    elif proximity_location:
+        ptd_name = snapshot.device(config.proximity_to)["name"]
+        dist = find_distance(estimate, proximity_location)
+        margins.append(abs(dist - config.distance))
+        if dist < config.distance:
+            msg = f"{ptd_name} is near {config.display_name}"
+            alert(notifier, 'Proximity Detected', msg, config.watch_proximity_audio,
+                  snapshot.device(config.watch_proximity_device_adb) if config.watch_proximity_device_cb else None)
+            config.log(msg)
+
+    config.margin = min(margins) if margins else None
+
+def alert(notifier, title, msg, audio, device):
+    # queued, so a slow channel never holds up the poll cycle
+    notifier.post('desktop', title, msg)
+    notifier.post('log', title, msg)
+    if audio:
+        notifier.post('speech', None, msg)
+    if device is not None:
+        notifier.post('device', title, msg, target=device)
+
+class RuleGraph:
+    # which trackees' rules read which entities, so a cycle only runs
+    # handle() for trackees something they read has changed for, and a
+    # cycle where little moved costs little. each snapshot marks the
+    # dependents of every entity with a new fix dirty, whether or not
+    # they're due this cycle
+    def __init__(self):
+        # entity id -> trackees whose rules read it
+        self.dependents = {}
+        # trackee -> entity ids it reads
+        self.inputs = {}
+        # entity id -> position_version() of its fix as of the last snapshot
+        self.versions = {}
+
+    def watch(self, trackee):
+        # (re)registers trackee, after adding it or changing what it reads
+        old = self.inputs.get(trackee, ())
+        inputs = self.inputs[trackee] = rule_inputs(trackee)
+        for key in inputs:
+            self.dependents.setdefault(key, set()).add(trackee)
+            self.versions.setdefault(key, None)
+        self.drop(trackee, [key for key in old if key not in inputs])
+        trackee.dirty = True
+
+    def forget(self, trackee):
+        self.drop(trackee, self.inputs.pop(trackee, ()))
+
+    def drop(self, trackee, keys):
+        for key in keys:
+            dependents = self.dependents.get(key)
+            if dependents is None:
+                continue
+            dependents.discard(trackee)
+            if not dependents:
+                del self.dependents[key]
+                del self.versions[key]
+
+    def mark(self, snapshot):
+        for key in snapshot.changed(self.versions):
+            for trackee in self.dependents[key]:
+                trackee.dirty = True
+
+    def evaluate(self, trackees, snapshot, notifier):
+        # runs handle() for the trackees among these that are dirty, edited,
+        # or have no fresh location to go on (handle() logs that), and
+        # returns them
+        self.mark(snapshot)
+        handled = []
+        for trackee in trackees:
+            if not (trackee.dirty or snapshot.age(trackee) is not None or
+                    not snapshot.has_location(trackee)):
+                continue
+            trackee.dirty = False
+            handle(trackee, snapshot, notifier)
+            handled.append(trackee)
+            if rule_inputs(trackee) != self.inputs.get(trackee):
+                self.watch(trackee)
+                trackee.dirty = False
+        return handled
+
+def rule_inputs(trackee):
+    # the entities whose fixes trackee's rules read
+    if trackee.watch_proximity and trackee.proximity_to is not None:
+        return (trackee.id, trackee.proximity_to)
+    return (trackee.id,)
+
+LogEntry = namedtuple('LogEntry', ['timestamp', 'lat', 'lng', 'delta', 'event'])
+
+def format_log_entry(entry):
+    line = entry.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+    if entry.lat is not None:
+        line += f" lat {entry.lat}, lng {entry.lng}"
+    if entry.delta is not None:
+        line += f", delta distance (meters): {entry.delta:.1f}"
+    if entry.event:
+        line += f" {entry.event}"
+    return line
+
+class TrackLog:
+    # a trackee's log as fixed size records in one buffer, the oldest
+    # overwritten once it's full. the same few messages come up over and
+    # over, so records refer to them by number
+    def __init__(self, capacity=LOG_CAPACITY):
+        self.capacity = capacity
+        self.records = bytearray()
+        self.count = 0
+        # message number - 1 -> message, and back
+        self.messages = []
+        self.message_numbers = {}
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, lat, lng, delta, event):
+        if event is not None and event not in self.message_numbers and len(self.messages) >= self.capacity:
+            self.forget_messages()
+        values = (int(timestamp), to_coordinate(lat), to_coordinate(lng),
+                  nan if delta is None else delta, self.message_number(event))
+        if self.count < self.capacity:
+            self.records += LOG_RECORD.pack(*values)
+        else:
+            LOG_RECORD.pack_into(self.records, (self.count % self.capacity) * LOG_RECORD.size, *values)
+        self.count += 1
+
+    def message_number(self, event):
+        if event is None:
+            return 0
+        number = self.message_numbers.get(event)
+        if number is None:
+            self.messages.append(event)
+            number = self.message_numbers[event] = len(self.messages)
+        return number
+
+    def forget_messages(self):
+        # keep only the messages entries still in the log refer to
+        entries = list(self)
+        self.messages = []
+        self.message_numbers = {}
+        for n, entry in zip(range(self.count - len(entries), self.count), entries):
+            offset = (n % self.capacity) * LOG_RECORD.size
+            timestamp, lat, lng, delta, _ = LOG_RECORD.unpack_from(self.records, offset)
+            LOG_RECORD.pack_into(self.records, offset, timestamp, lat, lng, delta,
+                                 self.message_number(entry.event))
+
+    def __iter__(self):
+        # LogEntry per entry, oldest first
+        return self.tail(len(self))
+
+    def tail(self, n):
+        # LogEntry per entry of the latest n, oldest first, without
+        # decoding the rest
+        for i in range(self.count - min(n, len(self)), self.count):
+            timestamp, lat, lng, delta, message = LOG_RECORD.unpack_from(
+                self.records, (i % self.capacity) * LOG_RECORD.size)
+            yield LogEntry(datetime.fromtimestamp(timestamp), from_coordinate(lat), from_coordinate(lng),
+                           None if isnan(delta) else delta, self.messages[message - 1] if message else None)
+
+def to_coordinate(degrees):
+    return NO_COORDINATE if degrees is None else int(round(degrees * COORDINATE_SCALE))
+
+def from_coordinate(value):
+    return None if value == NO_COORDINATE else value / COORDINATE_SCALE
+
+class TrackingConfig:
+    # one per trackee, so a fleet of them stays small: slots instead of a
+    # dict, just the icloud id instead of the object it came from, and the
+    # log as packed records
+    __slots__ = (
+        'type', 'id', 'display_name', 'watch_movement', 'tolerance', 'watch_movement_audio',
+        'watch_movement_device_cb', 'watch_movement_device_adb', 'watch_proximity', 'proximity_to',
+        'distance', 'watch_proximity_audio', 'watch_proximity_device_cb', 'watch_proximity_device_adb',
+        'geofence', 'watch_zones_audio', 'watch_zones_device_cb', 'watch_zones_device_adb',
+        'track', 'fix_version', 'estimate', 'last_location', 'dirty', 'speed', 'margin', 'poll_interval',
+        'log_entries', 'log_count', 'on_change',
+    )
+
+    def __init__(self, type, api_object, display_name, log_capacity=LOG_CAPACITY):
+        # either "device" or "friend"
+        self.type = type
+        self.id = api_object['id'] if api_object is not None else None
+        self.display_name = display_name
+
+        self.watch_movement = False
+        self.tolerance = 500.0
+        self.watch_movement_audio = False
+        self.watch_movement_device_cb = False
+        self.watch_movement_device_adb = None
+
+        self.watch_proximity = False
+        self.proximity_to = None
+        self.distance = 500.0
+        self.watch_proximity_audio = False
+        self.watch_proximity_device_cb = False
+        self.watch_proximity_device_adb = None
+
+        # a geofence.Geofence over the zones this trackee is watched in
+        self.geofence = None
+        self.watch_zones_audio = False
+        self.watch_zones_device_cb = False
+        self.watch_zones_device_adb = None
+
+        # polling state, see scheduler.next_interval
+        self.track = TrackFilter()
+        # the last fix the track was updated with, by position_version(),
+        # and the track's estimate as of that fix
+        self.fix_version = None
+        self.estimate = None
+        # the smoothed fix movement is measured from
+        self.last_location = None
+        # something the rules read changed since handle() last ran, see RuleGraph
+        self.dirty = True
+        self.speed = None
+        self.margin = None
+        self.poll_interval = DEFAULT_INTERVAL
+
+        self.log_entries = TrackLog(log_capacity)
+        # total entries ever logged, lets the ui tell which ones are new
+        self.log_count = 0
+
+        # called as on_change(trackee, field) after a rule is set through
+        # trackee[field] = value, and with 'log' after every log entry
+        self.on_change = None
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, val):
+        setattr(self, key, val)
+        # an edited rule is evaluated on the next poll even if nothing moved
+        self.dirty = True
+        if self.on_change is not None:
+            self.on_change(self, key)
+
+    def log(self, event=None, location=None, delta=None):
+        lat = location['latitude'] if location else None
+        lng = location['longitude'] if location else None
+        self.log_entries.append(time.time(), lat, lng, delta, event)
+        self.log_count += 1
+        if self.on_change is not None:
+            self.on_change(self, 'log')
+
+def needed_fetches(trackees):
+    # which of the two batched fetches a cycle over these trackees needs
+    need_friends = any(t.type == "friend" for t in trackees)
+    need_devices = any(t.type == "device" or t.watch_proximity or
+                       t.watch_movement_device_cb or t.watch_proximity_device_cb or
+                       t.watch_zones_device_cb
+                       for t in trackees)
+    return need_friends, need_devices